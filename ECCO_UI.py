@@ -773,7 +773,7 @@ class JuneLabClusteringGUI(ttk.Frame):
 
 	def integrity(self):
 		filename = filedialog.askopenfilename()
-		GU.dataIntegrity()
+		GU.dataIntegrity(filename)
 	
 	def mstF(self):
 		numClust =GU.MST(func='ensemble')
@@ -5,12 +5,7 @@ import pandas as pd
 import numpy as np
 from matplotlib import pyplot as plt
 from scipy.cluster.hierarchy import dendrogram
-from scipy.cluster.hierarchy import linkage
-from scipy.spatial.distance import pdist,squareform
-from scipy.sparse import csr_matrix
-from scipy.sparse.csgraph import minimum_spanning_tree
-import glob,sys,logging,time,os
-import statistics as stat
+import logging,time,os
 from multiprocessing import Pool
 import config
 import GuiBackground as GB
@@ -19,103 +14,62 @@ import mplcursors
 from ValidationMetric import ValidationMetric as VM
 
 class GUIUtils:
-    def dataIntegrity(file):
+    def dataIntegrity(file, run=None, outExt=None):
         '''
         The data integrity function checks and corrects Volcano plot outputs from MetaboAnalyst for extra decimals. 
 
         Input:
 
-        file - input full path to the file, use tkinter's filedialog for ease of getting file path. 
+        file - input full path to the file, use tkinter's filedialog for ease of getting file path. A directory can be given to correct 
+        every excel, csv and tsv file in it, the files are split over config.numThreads processes. 
+
+        run - optional GuiBackground.OutputRun the corrected file is saved to (defaults to the current working directory). 
+
+        outExt - optional extension of the corrected files ('.xlsx' or '.csv'), by default csv inputs give csv outputs and excel inputs give excel outputs. 
 
         Output: 
         
-        This function outputs an excel file with corrected values, the original file name has  _corrected appended to the end. 
+        This function outputs a file with corrected values, the original file name has  _corrected appended to the end. 
 
         '''
         #log that the user called the data integrity function
         logging.info(': User called the Data Integrity function.')
+        outDir = GB.getOutputRun(run).outDir
+
+        if os.path.isdir(file):
+            #correct every volcano plot output in the directory
+            files = []
+            for curFile in sorted(os.listdir(file)):
+                if os.path.splitext(curFile)[1].lower() in ('.xlsx','.xls','.csv','.tsv','.txt'):
+                    files.append(os.path.join(file,curFile))
+        else:
+            files = [file]
+        argsMulti = [(curFile,outDir,outExt) for curFile in files]
 
         try:
-            #Read in Volcano Plot data
-            if file[len(file)-1] == 'x':
-                volcano = pd.read_excel(file)
-            elif file[len(file)-1 == 'v']:
-                volcano = pd.read_csv(file)
+            if len(argsMulti) > 1 and config.numThreads > 1 and __name__ == 'GUIUtils':
+                with Pool(min(config.numThreads,len(argsMulti))) as p:
+                    outFiles = p.starmap(GB.integrityFile,argsMulti)
+            else:
+                outFiles = [GB.integrityFile(*args) for args in argsMulti]
+        except ValueError as err:
+            logging.error(': ' + str(err))
+            messagebox.showerror(title='Error',message=str(err))
+            return
         except:
             logging.error(': Failed to read in the excel file. Please put error in the Github issues tab.')
             messagebox.showerror(title='Error',message='Failed to read in the excel file. Please let Brady know!!')
             return
-            
-        #grab the first row the volcano data
-        check = volcano['Unnamed: 0']
-
-        #create array that can save the fixed data and the data that did not need to be fixed
-        correctedArray = np.zeros(check.shape[0])
-
-        #search each of the volcano data rows to determine if they have double decimals.
-        for i in range(check.shape[0]):
-            #grab the row corresponding to the current run through the loop
-            curVal = check[i]
-
-            #reset the number of decimals to 0 before checking the string for decimal points
-            decimal = 0
-
-            #creating a string that will contain the corrected string
-            corrected = ''
-
-            #Determine if the value is a float to allow for determination of whether or not we need to check it for the appropriate value
-            if isinstance(curVal,float) != True:
-                #Look through the strings to find data integrity issues. 
-                for j in range(len(curVal)):
-                    #Check for decimals otherwise add the value to a string
-                    value = curVal[j]
-                    if value == '.':
-                        decimal += 1
-                        if decimal == 1:
-                            corrected += value
-                    else:
-                        corrected += value
-                        if j == len(curVal)-1:
-                            try:
-                                correctedArray[i] = float(corrected)
-                            except:
-                                logging.error(': Unable to convert values to floats. Make sure all data values are only contain decimals or numberic values')
-                                return
-                    if decimal == 2:
-                        correctedArray[i] = corrected
-                        continue
-            else:
-                #save the data that did not need to be corrected to the correctedArray
-                correctedArray[i] = curVal
-
-        #Replace the values in the dataframe with the appropriate values
-        volcano['Unnamed: 0'] = correctedArray
-        del(correctedArray,i,curVal,decimal,corrected)
-
-        finalSlash = 0
-        for i in range(len(file)):
-            #determine the location of the final / in the name
-            if file[i] == '/':
-                finalSlash = i
-        file = file[finalSlash+1:len(file)-5]
-        #Replace the file name with the appropriate rename
-        file += '_corrected.xlsx'
-        #specify the file to write to
-        output = pd.ExcelWriter(file)
-
-        #write to excel file
-        volcano.to_excel(output,index=False)
-        del(volcano)
-        #save the excel sheet
-        output.save()
-        logOut = 'Updated file saved as: ' + file
-        logging.info(logOut)
+
+        for outFile in outFiles:
+            logOut = 'Updated file saved as: ' + outFile
+            logging.info(logOut)
         #log that the data integrity function has been sucessfully completed. 
         logging.info(': Data Integrity check sucessfully completed.')
         messagebox.showinfo(title="Success",message="Removed data integrity issues!!")
         return
 
-    def createClustergram(norm,linkFunc,distMet,cmap,colOrder=[], transform = 'None', scale ='None'):
+    def createClustergram(norm,linkFunc,distMet,cmap,colOrder=[], transform = 'None', scale ='None', dataset=None, run=None):
         '''
         The function is responsible for generating the clustergrams for multivariate data. This function is capable of
         using all the linkage functions and distance measures currently implemented to the scipy.hierarchy method. OF
@@ -129,6 +83,10 @@ class GUIUtils:
 
         distMet - input a string for the distance measure you would like to use (i.e., 'euclidean')
 
+        dataset - optional Dataset (GuiBackground.loadDataset) that has already been read in, otherwise the user is asked for a file. 
+
+        run - optional GuiBackground.OutputRun the clustergram is saved to (defaults to the current working directory). 
+
         Output:
 
         This function outputs a .png of the generated clustergram. 
@@ -144,7 +102,9 @@ class GUIUtils:
         logMessage = ': Data Transform: ' + transform +'; Data Scaling: ' + scale
         logging.info(logMessage)
 
-        fileI = filedialog.askopenfilename()
+        if dataset is None:
+            dataset = filedialog.askopenfilename()
+        fileI = dataset
         
         try:
             if norm == 0 or norm == 2:
@@ -158,14 +118,18 @@ class GUIUtils:
             return
 
         #create dendrogram and plot data        
-        GB.create_dendrogram(data,col_groups, norm, link=linkFunc, dist=distMet,color = cmap,colOrder=colOrder)
+        GB.create_dendrogram(data,col_groups, norm, link=linkFunc, dist=distMet,color = cmap,colOrder=colOrder,run=run)
 
         del(data,norm,linkFunc,distMet)
 
+        #wait for the clustergram to finish saving
+        if not GB.flushOutputs():
+            return
+
         logging.info(': Sucessfully created the wanted Clustergram')
         return
 
-    def groupMedians(rmZeros=0):
+    def groupMedians(rmZeros=0, run=None, stats=None):
         '''
         Determine the number of groups and then create a list or array of the appropriate
         beginning and ending of each group. This assumes that the groups are all of equal size which should be
@@ -176,6 +140,8 @@ class GUIUtils:
         Input:
         
         groupMedians does not accept any inputs, it will prompt you to select a file which you would like to have medians determined for. 
+        The output is saved to run (an optional GuiBackground.OutputRun, defaults to the current working directory). 
+        stats - optional list of extra group statistics ('mean', 'mad', 'nonzero') saved as additional sheets, defaults to config.groupStats. 
 
         Output:
 
@@ -197,43 +163,20 @@ class GUIUtils:
         metaboliteIdentities = list(medians.columns)
         metaboliteIdentities = metaboliteIdentities[2:len(metaboliteIdentities)]
 
-        #put groups into a list so we know how many groups we need to find the median for.
-        groups = set(groups)
-        groups = sorted(groups)
-
-        #get the groupID for each sample
-        samples = list(medians['mz'])
-
-        #create numpy array that contains the medians...
-        mediansOut = np.zeros((len(metaboliteIdentities),len(groups)+2))
-
-
-        for i in range(len(groups)):
-            #create list of indicies for the program to obtain
-            curInd = []
-            numFound = 0
-            #get theh current number of times a particular group is present.
-            numLocs = samples.count(groups[i])
-            for j in range(len(samples)):
-                #find the numLocs
-                curEntry = samples[j]
-                if curEntry == groups[i]:
-                    #add one to the numFound
-                    numFound += 1
-                    curInd.append(j)
-                    if numFound == numLocs:
-                        break
-
-            #determine the median for each metabolite across the samples for each group
-            for j in range(len(metaboliteIdentities)):
-                #for each metabolite grab the current list of data
-                curMetabMed = []
-                for k in range(len(curInd)):
-                    #add values too list that are from the list of values
-                    curMetabMed.append(medians[metaboliteIdentities[j]][curInd[k]])
-
-                curMedian = stat.median(curMetabMed)
-                mediansOut[j,i+1] = curMedian
+        if stats is None:
+            stats = config.groupStats
+        stats = ['median'] + [statName for statName in stats if statName != 'median']
+
+        #reduce the samples of each group for every metabolite in a single pass
+        groups, reduced = GB.groupReduce(medians[metaboliteIdentities].to_numpy(dtype=float),groups.to_numpy(),stats=stats)
+        groups = list(groups)
+
+        #create numpy arrays that contain the medians (and other statistics) with the m/z and rt_med columns
+        statsOut = {}
+        for statName in reduced:
+            statsOut[statName] = np.zeros((len(metaboliteIdentities),len(groups)+2))
+            statsOut[statName][:,1:len(groups)+1] = reduced[statName].T
+        mediansOut = statsOut['median']
 
         for i in range(len(metaboliteIdentities)):
             #check if theh current value is a string, if it is then fix string. 
@@ -249,29 +192,17 @@ class GUIUtils:
 
             else:
                 mediansOut[i,0] = metaboliteIdentities[i]
+        for statName in statsOut:
+            statsOut[statName][:,0] = mediansOut[:,0]
 
         if rmZeros == 1:
-            #create a numpy array that cna continually be added to. 
-            mediansNZ = np.zeros((1,mediansOut.shape[1]))
-
             #remove the zeros from the data sheet, allowing the final data sheet to only contain detected metabolites.
-            #number of groups to determine whether or not to keep the column. 
+            #keep the metabolites with medians of zero in less than half of the groups. 
             numGroups = len(groups)
-            for i in range(len(metaboliteIdentities)):
-                #get the current row from the numpy array
-                curRow = mediansOut[i,1:mediansOut.shape[1]-1]
-                curZero = np.where(curRow == 0)
-                numZero = len(curZero[0])
-                if numZero/numGroups < 0.5:
-                    #add the row to the output of medians NZ
-                    newRow = np.zeros((1,mediansOut.shape[1]))
-                    newRow[0,0] = mediansOut[i,0]
-                    newRow[0,newRow.shape[1]-1] = mediansOut[i,mediansOut.shape[1]-1]
-                    newRow[0,1:newRow.shape[1]-1] = curRow
-                    mediansNZ = np.vstack([mediansNZ, newRow])
-
-            mediansNZ = np.delete(mediansNZ,0,0)
-            mediansOut = mediansNZ
+            keep = np.count_nonzero(mediansOut[:,1:mediansOut.shape[1]-1] == 0,axis=1)/numGroups < 0.5
+            for statName in statsOut:
+                statsOut[statName] = statsOut[statName][keep,:]
+            mediansOut = statsOut['median']
             logging.info(': Zeros removed from the data set!')
         else:
             logging.info(': Zeros are not being removed!')
@@ -281,17 +212,21 @@ class GUIUtils:
         columns.extend(groups)
         columns.append('rt_med')
 
-        mediansExcel = pd.DataFrame(data=mediansOut,columns=columns)
-        file = file[0:len(file)-5]
-        file = file + 'Medians.xlsx'
-        mediansExcel.to_excel('MediansOutput.xlsx',index=False,sheet_name="Medians")
+        #save the medians and any other statistics as sheets of the same workbook
+        sheetNames = {'median':"Medians",'mean':"Mean",'mad':"MAD",'nonzero':"NonzeroFraction"}
+        sheets = {}
+        for statName in statsOut:
+            sheets[sheetNames[statName]] = pd.DataFrame(data=statsOut[statName],columns=columns)
+        with pd.ExcelWriter(GB.getOutputRun(run).path('MediansOutput.xlsx')) as writer:
+            for sheet in sheets:
+                sheets[sheet].to_excel(writer,index=False,sheet_name=sheet)
 
         #logging the completion of the group medians function
         logging.info(': Successfully grouped the Medians of each group!')
         messagebox.showinfo(title="Success",message="Successfully created MediansOutput.xlsx file!!")
         return
 
-    def linkageComparison(file,num_comps,linkList,distance, transform,scale):
+    def linkageComparison(file,num_comps,linkList,distance, transform,scale, run=None):
         '''
         Compares 2-4 linkage functions on a given set of data. 
         
@@ -299,19 +234,19 @@ class GUIUtils:
 
         Input:
 
-        file - include full file path, use the tkinter filedialog functionality for ease of obtaining file path
+        file - include full file path, use the tkinter filedialog functionality for ease of obtaining file path (or a Dataset that has already been read in)
 
         num_of_comps - make sure to give an integer the same length as the link list. 
             
         linkList - list of linkage functions that you would like to have compared. 
 
+        run - optional GuiBackground.OutputRun the figure is saved to (defaults to the current working directory). 
+
         Output:
 
-        linkageComparison saves a .png file of the output to the current working directory. 
+        linkageComparison saves a .png file of the output to the run directory. 
         '''
 
-        #set recursion limit above the common max for our data.
-        sys.setrecursionlimit(10**8)
         #Log that user called linkage comparison function
         logging.info(': User called the Linkage Comparison function.')
         #check that the file is appropriate for our data set
@@ -320,7 +255,7 @@ class GUIUtils:
         del(col_groups)
         #input the arguments to the log file so user has record of what was input.
         logging.info(':-------------------------------------------------------------')
-        logMessage = file
+        logMessage = str(file)
         logging.info(logMessage)
         logMessage = ': Number of comparisons: ' + str(num_comps)
         logging.info(logMessage)
@@ -333,13 +268,14 @@ class GUIUtils:
 
         #convert string to integer
         num_comps = int(num_comps)
+
+        #linkages of the same data are taken from the session cache
+        fingerprint = GB.dataFingerprint(data)
         
         if num_comps == 2:
             #Create the linkage matrix
-            linkageOne = linkage(data,linkList[0], metric=distance)
-            distMeasure = pdist(data)
-            distMeasure = squareform(distMeasure)
-            linkageTwo = linkage(data,linkList[1], metric=distance)
+            linkageOne = GB.cachedLinkage(data,linkList[0],distance,fingerprint=fingerprint)
+            linkageTwo = GB.cachedLinkage(data,linkList[1],distance,fingerprint=fingerprint)
 
             #Create the appropriate plt figure to allow for the comparison of linkage functions
             fig, axes = plt.subplots(1,2,figsize=(8,8))
@@ -353,16 +289,17 @@ class GUIUtils:
             sameColor = []
             for i in range(maxLinkNum+2):
                 sameColor.append('k')
-            #create the dendrograms
-            dend1 = dendrogram(linkageOne,ax=axes[0],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
-            dend2 = dendrogram(linkageTwo,ax=axes[1],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
+            #create the dendrograms (scipy's dendrogram recurses as deep as the trees)
+            with GB.recursionLimit(max(GB.linkageDepth(linkageOne),GB.linkageDepth(linkageTwo))):
+                dend1 = dendrogram(linkageOne,ax=axes[0],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
+                dend2 = dendrogram(linkageTwo,ax=axes[1],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
                 
             del(linkageOne,linkageTwo,num_comps)
         elif num_comps == 3:
             #Create the linkage matrix
-            linkageOne = linkage(data,linkList[0],metric=distance)
-            linkageTwo = linkage(data,linkList[1],metric=distance)
-            linkageThree = linkage(data,linkList[2], metric=distance)
+            linkageOne = GB.cachedLinkage(data,linkList[0],distance,fingerprint=fingerprint)
+            linkageTwo = GB.cachedLinkage(data,linkList[1],distance,fingerprint=fingerprint)
+            linkageThree = GB.cachedLinkage(data,linkList[2],distance,fingerprint=fingerprint)
 
             #Create the appropriate plt figure to allow for the comparison of linkage functions
             fig, axes = plt.subplots(1,3,figsize=(8,8))
@@ -379,18 +316,19 @@ class GUIUtils:
             sameColor = []
             for i in range(maxLinkNum+2):
                 sameColor.append('k')
-            #create the dendrograms
-            dend1 = dendrogram(linkageOne,ax=axes[0],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
-            dend2 = dendrogram(linkageTwo,ax=axes[1],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
-            dend3 = dendrogram(linkageThree,ax=axes[2],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
+            #create the dendrograms (scipy's dendrogram recurses as deep as the trees)
+            with GB.recursionLimit(max(GB.linkageDepth(linkageOne),GB.linkageDepth(linkageTwo),GB.linkageDepth(linkageThree))):
+                dend1 = dendrogram(linkageOne,ax=axes[0],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
+                dend2 = dendrogram(linkageTwo,ax=axes[1],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
+                dend3 = dendrogram(linkageThree,ax=axes[2],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
             del(linkageOne,linkageTwo,linkageThree,num_comps)
         elif num_comps == 4:
 
             #Create the linkage matrix
-            linkageOne = linkage(data,linkList[0],metric=distance)
-            linkageTwo = linkage(data,linkList[1],metric=distance)
-            linkageThree = linkage(data,linkList[2],metric=distance)
-            linkageFour = linkage(data, linkList[3],metric=distance)
+            linkageOne = GB.cachedLinkage(data,linkList[0],distance,fingerprint=fingerprint)
+            linkageTwo = GB.cachedLinkage(data,linkList[1],distance,fingerprint=fingerprint)
+            linkageThree = GB.cachedLinkage(data,linkList[2],distance,fingerprint=fingerprint)
+            linkageFour = GB.cachedLinkage(data,linkList[3],distance,fingerprint=fingerprint)
 
             #Create the appropriate figure to allow for the comparison of linkage functions
             fig, axes = plt.subplots(2,2,figsize=(8,8))
@@ -409,17 +347,16 @@ class GUIUtils:
             for i in range(maxLinkNum+2):
                 sameColor.append('k')
 
-            #create the dendrograms
-            dend1 = dendrogram(linkageOne,ax=axes[0,0],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
-            dend2 = dendrogram(linkageTwo,ax=axes[0,1],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
-            dend3 = dendrogram(linkageThree,ax=axes[1,0],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
-            dend4 = dendrogram(linkageFour,ax=axes[1,1],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
+            #create the dendrograms (scipy's dendrogram recurses as deep as the trees)
+            with GB.recursionLimit(max(GB.linkageDepth(linkageOne),GB.linkageDepth(linkageTwo),GB.linkageDepth(linkageThree),GB.linkageDepth(linkageFour))):
+                dend1 = dendrogram(linkageOne,ax=axes[0,0],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
+                dend2 = dendrogram(linkageTwo,ax=axes[0,1],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
+                dend3 = dendrogram(linkageThree,ax=axes[1,0],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
+                dend4 = dendrogram(linkageFour,ax=axes[1,1],above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
             del(linkageOne,linkageTwo,linkageThree,linkageFour,num_comps)
         elif num_comps == 1:
             #Create the linkage matrix
-            linkageOne = linkage(data,linkList[0], metric=distance)
-            distMeasure = pdist(data)
-            distMeasure = squareform(distMeasure)
+            linkageOne = GB.cachedLinkage(data,linkList[0],distance,fingerprint=fingerprint)
 
             #Create the appropriate plt figure to allow for the comparison of linkage functions
             fig, axes = plt.subplots(1,1,figsize=(8,8))
@@ -433,53 +370,30 @@ class GUIUtils:
             for i in range(maxLinkNum+2):
                 sameColor.append('k')
 
-            dend1 = dendrogram(linkageOne,ax=axes,above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
+            #create the dendrogram (scipy's dendrogram recurses as deep as the tree)
+            with GB.recursionLimit(GB.linkageDepth(linkageOne)):
+                dend1 = dendrogram(linkageOne,ax=axes,above_threshold_color='y',orientation='left',no_labels=True, link_color_func= lambda x: sameColor[x])
                 
 
-        linkPre = 'LinkageComparison'
-        linkSuf = '.png'
-        sep = '_'
-        firstCheck = linkPre+sep
+        #name the figure after the linkage functions compared, numbered after earlier comparisons
+        linkPre = 'LinkageComparison_'
         for i in range(len(linkList)):
-            #create the first file check
-            firstCheck += linkList[i] + sep
-
-        firstCheck += '01' + linkSuf
-
-        chkBuffer = glob.glob("*.png")
-        count = 1
-        if firstCheck in chkBuffer:
-            checkVal = False
-            firstCheck = firstCheck.strip(linkSuf)
-            firstCheck = firstCheck.strip('01')
-            while checkVal == False:
-                count += 1
-                #search the "buffer" for ensemble cluster
-                if count < 10:
-                    #determine if the file has already been made
-                    curFileCheck = firstCheck + '0' + str(count) + linkSuf
-                    if curFileCheck not in chkBuffer:
-                        checkVal = True
-                        linkFile = curFileCheck
-
-                else:
-                    curFileCheck = firstCheck + str(count) + linkSuf
-                    if curFileCheck not in chkBuffer:
-                        checkVal = True
-                        linkFile = curFileCheck
-            plt.savefig(linkFile,dpi=600,transparent=True)
-        else:
-            linkFile = firstCheck 
-            plt.savefig(linkFile,dpi=600,transparent=True)
+            linkPre += linkList[i] + '_'
+        linkFile = GB.getOutputRun(run).nextNames(linkPre,'.png')[0]
+        GB.getOutputWriter().saveFigure(plt.gcf(),linkFile,dpi=600,transparent=True)
 
         plt.show()
 
+        #wait for the figure to finish saving
+        if not GB.flushOutputs():
+            return
+
         #log the completion of the linkage comparison
         logging.info(': Sucessfuly completed the comparison of the linkage functions!')
         return
                 
 
-    def ensembleClustering(optNum=2, minMetabs = 0, colorMap='viridis',linkParams=[],transform = 'None',scale='None', type='base'):
+    def ensembleClustering(optNum=2, minMetabs = 0, colorMap='viridis',linkParams=[],transform = 'None',scale='None', type='base', dataset=None, run=None):
         '''
         The distance measures and linkage functions should be consistent but we could also develop
         a GUI that allows for the users to select various distance measures. The linkage functions 
@@ -493,6 +407,10 @@ class GUIUtils:
 
         optNum - Input the optimum number of clusters for these data based upon a minimum spanning tree optimization of the data. 
 
+        dataset - optional Dataset (GuiBackground.loadDataset) that has already been read in, otherwise the user is asked for a file. 
+
+        run - optional GuiBackground.OutputRun the outputs are saved to (defaults to the current working directory). 
+
         Output:
 
         A figure output by these data will be saved as a .png to the current working directory. Additionally, the red-dashed lines around the 
@@ -503,67 +421,81 @@ class GUIUtils:
         #log that the user called ensemble clustering function
         logging.info(': User called Ensemble Clustering function.')
 
-        #optimum number of clusters from validation index.
-        sys.setrecursionlimit(10**8)
-        file = filedialog.askopenfilename()
-        data, col_groups = GB.readAndPreProcess(file=file,transform=transform,scale=scale,func='CC')
-        del(col_groups)
+        if dataset is None:
+            #read the file in a single time for the pre-processed and raw data
+            file = filedialog.askopenfilename()
+            dataset = GB.loadDataset(file=file)
 
         #determine whether data read in or not.
-        if data is None:
+        if dataset is None:
             messagebox.showerror(title='Error',message='No file selected, returning to GUI. If you wish to continue with ensemble clustering, click continue and then select file!')
             return
+
+        data, col_groups = GB.readAndPreProcess(file=dataset,transform=transform,scale=scale,func='CC')
+        del(col_groups)
         
         #read in data as dataframe for ease of use in recClusters, and ensembleClustersOut
-        metab_data = GB.readAndPreProcess(file=file, transform='None', scale='None', func='Raw')
+        metab_data = GB.readAndPreProcess(file=dataset, transform='None', scale='None', func='Raw')
         #List for the use in creating and plotting the clustering results
         # linkParams = [['ward','euclidean'],['single','euclidean'],['single','sqeuclidean'],['single','seuclidean'],['single','chebyshev'],['complete','euclidean'],['complete','sqeuclidean'],['complete','seuclidean'],['complete','chebyshev'],['average','euclidean'],['average','sqeuclidean'],['average','seuclidean'],['average','chebyshev']]
 
         #calculate the number of clusterings based upon the size of the lists and an additional term for the ward-euclidean run. 
         numClusterings = (len(linkParams))
 
-        #determine the the number of clusters and the dictionary location that needs to be called. 
-        numMetabs = data.shape[0]
-        dictLoc = numMetabs-optNum-1
-
-        #create co-occurrence matrix.
-        coOcc = GB.cooccurrence(data)
+        #create the compact co-occurrence matrix (integer counts of the upper triangle).
+        coOcc = GB.CoOccurrence(data.shape[0],numClusterings)
 
-        for i in range(len(linkParams)):
-            start = time.perf_counter()
-            linkCur = linkage(data,linkParams[i][0],linkParams[i][1])
-            valid = GB.clustConnectLink(linkCur)
-            coOcc = GB.popCooccurrence(valid[dictLoc],coOcc,numClusterings)
+        #cluster the members across the worker processes, adding each partition to the co-occurrence matrix as it finishes
+        start = time.perf_counter()
+        for linkCur, distCur, valid in GB.ensembleMembers(data,linkParams,optNum,numThreads=config.numThreads,cache=GB.getLinkageCache()):
+            coOcc = GB.popCooccurrence(valid,coOcc,numClusterings)
             end = time.perf_counter()
-            logging.info(': ' +str(linkParams[i][0])+'-'+str(linkParams[i][1]) +' done!')
+            logging.info(': ' +str(linkCur)+'-'+str(distCur) +' done!')
             logging.info(str(end-start))
         del(linkParams)
 
-        #make the coOccurence matrix a dataframe.
-        coOcc1 = pd.DataFrame(coOcc)
+        writer = GB.getOutputWriter()
+        run = GB.getOutputRun(run)
+        try:
+            #save the condensed co-occurrence counts in the background, reload with GB.CoOccurrence.load('EnsembleCoOcc.npz')
+            coOccFile = run.path('EnsembleCoOcc.npz')
+            writer.submit(coOccFile,coOcc.save,coOccFile,compress=config.coOccCompress)
+        except:
+            logging.error(': Failed to save the Ensemble CoOccurence matrix!!')
+            messagebox.showerror(title='Error',message='Unable to save Ensemble CoOccurent matrix, please inform Brady!')
+
+        #expand the counts into the normalized NxN matrix needed for the ensemble clustergram
+        coOcc = coOcc.square()
+
         try:
-            #try to save the large .csv file of the CoOccurence matrix.
-            coOcc1.to_csv('EnsembleCoOcc.csv',index=False)
+            if config.coOccCSV:
+                #optionally save the large .csv file of the CoOccurence matrix.
+                writer.saveTable(pd.DataFrame(coOcc),run.path('EnsembleCoOcc.csv'),index=False)
         except:
             logging.error(': Failed to save the Ensemble CoOccurence matrix!!')
             messagebox.showerror(title='Error',message='Unable to save Ensemble CoOccurent matrix, please inform Brady!')
 
         #create the ensemble dendrogram using ward-euclidean inputs. 
-        GB.createEnsemDendrogram(coOcc,metab_data,norm=0,minMetabs=minMetabs,numClusts=numClusterings,link='ward',dist='euclidean',func="ensemble",colMap=colorMap)
+        GB.createEnsemDendrogram(coOcc,metab_data,norm=0,minMetabs=minMetabs,numClusts=numClusterings,link='ward',dist='euclidean',func="ensemble",colMap=colorMap,run=run,dataset=dataset)
+
+        #wait for the output files to finish writing
+        if not GB.flushOutputs():
+            return
 
         #Log the completgroupion of the ensemble clustering function
         logging.info(': Sucessfully completed Ensemble clustering!')
         
         return
 
-    def MST(self,transform ='None',scale ='None', func = 'k-means based'):
+    def MST(self,transform ='None',scale ='None', func = 'k-means based', dataset=None, run=None):
         '''
         MST generates a minimum spanning tree of input data, and then validates the optimum number of clusters based upon a validation index of 
         the ***intra/inter*** cluster distances.
 
         Input:
 
-        MST doesn't accept inputs, and will prompt you for an input file. 
+        MST doesn't require inputs, and will prompt you for an input file unless a Dataset (GuiBackground.loadDataset) is given. 
+        The csv files and figure are saved to run (an optional GuiBackground.OutputRun, defaults to the current working directory). 
 
         Output:
         
@@ -574,9 +506,10 @@ class GUIUtils:
         #log that user called MST
         logging.info(': User called Cluster validation function.')
 
-        filename = filedialog.askopenfilename()
+        if dataset is None:
+            dataset = filedialog.askopenfilename()
         try:
-            data, col_groups = GB.readAndPreProcess(file=filename, transform = transform, scale =scale, func='CC')
+            data, col_groups = GB.readAndPreProcess(file=dataset, transform = transform, scale =scale, func='CC')
         except BaseException:
             logging.error(': Unable to proceed, due to file error!')
             messagebox.showerror(title='Error',message='Unable to proceed, try again or return to homepage!')
@@ -584,178 +517,72 @@ class GUIUtils:
 
         num_groups=data.shape[1]
 
-        #find the distance matrix using the pairwise distance function, put into squareform, appropriate format for mst and submit. 
-        pairWise = pdist(data)
-        pairWise = squareform(pairWise)
-        mstInput = csr_matrix(pairWise)
-        mstOut = minimum_spanning_tree(mstInput)
-
-        #get out the non-zero indicies. 
-        mstOutInd = mstOut.nonzero()
-
-        #create the matrix containing the various connections of the mst
-        mstOutMat = mstOut.todense()
-        dataMST = np.zeros([data.shape[0]-1,3])
-
-        for i in range(data.shape[0]-1):
-            #input the values of each matrix element to the numpy array for saving to csv file.
-            dataMST[i,0] = mstOutInd[0][i]
-            dataMST[i,1] = mstOutInd[1][i]
-            dataMST[i,2] = mstOut[dataMST[i,0],dataMST[i,1]]
+        #find the minimum spanning tree (sorted by distance) a row of distances at a time, shared through the linkage cache with 
+        #single-euclidean ensemble clustering
+        dataMST = GB.cachedMST(data,'euclidean')
 
         #Input the dataMST into the dataframe to save the results of the MST for future use if needed
         mstOut = pd.DataFrame(dataMST, columns=['index1','index2','dist'])
-        mstOut = mstOut.sort_values(by='dist')
-        mstOutNp = mstOut.to_numpy()
-
-        mstOutMat = pd.DataFrame(mstOutMat)
- 
-        #determine how the minimum spanning tree was created for validation of clusters
-        validationClusters = GB.clustConnect(dataMST,mstOutNp)
 
+        #each level of the hierarchy checked is rebuilt from the tree edges as it is validated, the k-means based, DBI and PBM indices
+        #are found for every level in a single sweep over the merges
         if func == 'k-means based':
             #Validate the number of clusters that should be used in the clustering solutions.
-            #create a list of tuples containing the single cluster set, with the data and the num_groups
-            argsMulti = []
-            
             logging.info(": Starting k-means based cluster validation!")
             start = time.perf_counter()
-            if len(validationClusters) < 100:
-                for i in range(len(validationClusters)):
-                    if i >= len(validationClusters)-(int(len(validationClusters)/2)):
-                        argsMulti.append(({0:validationClusters[i]},data,num_groups))
-            else:
-                for i in range(len(validationClusters)):
-                    if i >= len(validationClusters)-101:
-                        argsMulti.append(({0:validationClusters[i]},data,num_groups))
-            
-            if __name__ == 'GUIUtils':
-                with Pool(config.numThreads) as p:
-                    valIndex = p.starmap(GB.Validate,argsMulti)
-            
+            valIndex = GB.validationSweep(data,dataMST)['KMeansBased']
             end = time.perf_counter()
             logging.info(':'+str(end-start))
-            valIndex = np.asarray(valIndex)
-            GB.valPlotting(valIndex,mstOut)
+            GB.valPlotting(valIndex,mstOut,run=run)
 
         elif func=='DBI':
             logging.info(": Starting Davies-Bouldin cluster validation!")
 
-            #start tracking the performance of non-threaded DBI validation
+            #start tracking the performance of DBI validation
             start = time.perf_counter()
-            valIndex = np.zeros((len(validationClusters),2))
-
-            argsMulti = []
-            if len(validationClusters) < 100:
-                for i in range(len(validationClusters)):
-                    if i >= len(validationClusters)-(int(len(validationClusters)/2)):
-                        argsMulti.append(({0:validationClusters[i]},data,num_groups))
-            else:
-                for i in range(len(validationClusters)):
-                    if i >= len(validationClusters)-101:
-                        argsMulti.append(({0:validationClusters[i]},data,num_groups))
-
-            if __name__ == 'GUIUtils':
-                with Pool(config.numThreads) as p:
-                    valIndex = p.starmap(VM.daviesBouldin,argsMulti)
-
-            
+            valIndex = GB.validationSweep(data,dataMST)['DBI']
             end = time.perf_counter()
-            valIndex = np.asarray(valIndex)
 
-            GB.valPlotting(valIndex,mstOut,valMet = func)
+            GB.valPlotting(valIndex,mstOut,valMet = func,run=run)
 
         elif func == 'Dunn':
             logging.info(": Starting Dunn cluster validation!")
 
             start = time.perf_counter()
-            valIndex = np.zeros((len(validationClusters),2))
-
-            argsMulti = []
-            if len(validationClusters) < 100:
-                for i in range(len(validationClusters)):
-                    if i >= len(validationClusters)-(int(len(validationClusters)/2)):
-                        argsMulti.append(({0:validationClusters[i]},data,num_groups))
-            else:
-                for i in range(len(validationClusters)):
-                    if i >= len(validationClusters)-101:
-                        argsMulti.append(({0:validationClusters[i]},data,num_groups))
-
-            if __name__ == 'GUIUtils':
-                with Pool(config.numThreads) as p:
-                    valIndex = p.starmap(VM.dunnIndex,argsMulti)
-
-            
+            valIndex = GB.validationScores(VM.dunnIndex,data,dataMST,(num_groups,),numThreads=config.numThreads)
             end = time.perf_counter()
-            valIndex = np.asarray(valIndex)
 
-            GB.valPlotting(valIndex,mstOut,valMet='Dunn')
+            GB.valPlotting(valIndex,mstOut,valMet='Dunn',run=run)
 
         elif func == 'PBM':
             logging.info(": Starting PBM cluster validation!")
 
-            #find the center of all the data.
-            dataPatCenter = np.mean(data, axis=0)
-
-            #put the center at the top of the numpy array to find the sum of the distances
-            dataC = np.vstack([dataPatCenter,data])
-            
-            #find the distances and sum them
-            distances = pdist(dataC)
-            distances = squareform(distances)
-            Eo = np.sum(distances[0,:])
-
-            #start tracking the performance of the threaded PBM valdidation metric
+            #start tracking the performance of the PBM valdidation metric
             start = time.perf_counter()
-            valIndex = np.zeros((len(validationClusters),2))
-
-            argsMulti = []
-
-            if len(validationClusters) < 100:
-                for i in range(len(validationClusters)):
-                    if i >= len(validationClusters)-(int(len(validationClusters)/2)):
-                        argsMulti.append(({0:validationClusters[i]},data,num_groups,Eo))
-            else:
-                for i in range(len(validationClusters)):
-                    if i >= len(validationClusters)-101:
-                        argsMulti.append(({0:validationClusters[i]},data,num_groups,Eo))
-
-            if __name__ == 'GUIUtils':
-                with Pool(config.numThreads) as p:
-                    valIndex = p.starmap(VM.PBM,argsMulti)
-
-            
+            valIndex = GB.validationSweep(data,dataMST)['PBM']
             end = time.perf_counter()
-            valIndex = np.asarray(valIndex)
-            GB.valPlotting(valIndex,mstOut,valMet='PBM')
+
+            GB.valPlotting(valIndex,mstOut,valMet='PBM',run=run)
             
         elif func == 'Silhouette':
             logging.info(": Starting Silhouette cluster validation!")
 
-            #start tracking the performance of non-threaded DBI validation
+            #start tracking the performance of Silhouette validation
             start = time.perf_counter()
-            valIndex = np.zeros((len(validationClusters),2))
-
-            argsMulti = []
-            if len(validationClusters) < 100:
-                for i in range(len(validationClusters)):
-                    if i >= len(validationClusters)-(int(len(validationClusters)/2)):
-                        argsMulti.append(({0:validationClusters[i]},data,num_groups))
-            else:
-                for i in range(len(validationClusters)):
-                    if i >= len(validationClusters)-101:
-                        argsMulti.append(({0:validationClusters[i]},data,num_groups))
+            valIndex, valErrors, clusterErrors = GB.silhouetteSweep(data,dataMST,blockSize=config.silhouetteBlock,sampleSize=config.silhouetteSample,
+                                                                  confidence=config.silhouetteConfidence,seed=config.silhouetteSeed)
+            end = time.perf_counter()
+            if config.silhouetteSample is not None:
+                logging.info(': Silhouette estimated from '+str(config.silhouetteSample)+' features per cluster (seed '+str(config.silhouetteSeed)+'), error bound '
+                             +str(np.max(valErrors))+', largest cluster error bound '+str(max(np.max(curErrors,initial=0) for curErrors in clusterErrors)))
 
-            if __name__ == 'GUIUtils':
-                with Pool(config.numThreads) as p:
-                    valIndex = p.starmap(VM.Silhouette,argsMulti)
+            GB.valPlotting(valIndex,mstOut,valMet="Silhouette",run=run)
 
-            end = time.perf_counter()
-            valIndex = np.asarray(valIndex)
-            GB.valPlotting(valIndex,mstOut,valMet="Silhouette")
+        #wait for the validation outputs to finish writing
+        GB.flushOutputs()
 
 
-    def peaksToPathways():
+    def peaksToPathways(run=None):
         '''
         Create input files for the mummichog algorithm, using files output from the ensemble clustering and the in the future from the clustergram function. 
 
@@ -764,11 +591,16 @@ class GUIUtils:
         peaksToPathways does not accept any inputs but will prompt the user for two inputs. First, the user will need to select the original files for there ensemble clustered data. 
         Next, the user will need to select the directory containing the files generated by the ensemble clustering function. 
 
+        run - optional GuiBackground.OutputRun for the output files, by default they are saved to P2PFiles in the selected directory. 
+
         Output:
 
         This function will output csv files containing the m/z value and p-values fo the matched metabolites (p-values =0.04), and the remaining the metabolites with p-values equal to 1. 
         '''
         logging.info(': Entering the Peaks to Pathways generator!')
+        #make sure cluster files from earlier analyses have been written
+        if not GB.flushOutputs():
+            return
         #ask user to input the file name of the original data
         messagebox.showinfo(title='File selection', message="Please select the original data file submitted for clustering!!")
         filename = filedialog.askopenfilename()
@@ -782,114 +614,51 @@ class GUIUtils:
         #ask user to select the directory containing the csv files from ensemble clustering output (currently only method available)
         messagebox.showinfo(title="Directory Selection",message="Please select the directory containing the ensemble clustering output files!")
         direct = filedialog.askdirectory()
-        curDir = os.getcwd()
-
-        #change the current working directory to 
-        os.chdir(direct)
-
-
-
-        files = glob.glob('*.xlsx')
+        if run is None:
+            run = GB.OutputRun(direct)
 
+        #find the ensemble and selected cluster files in the directory
         ensemFiles = []
-        dirLog = os.getcwd()
-        for i in range(len(files)):
-            #strip the beginning of the strip off and then check the first 5 characters of the stripped string
-            #curCheck = files[i].strip(nameCheckStriper)
-            curCheck =files[i]
-            if curCheck[0:5] == 'Ensem':
-                #append to ensemFiles
-                ensemFiles.append(direct + '/' + curCheck)
-            elif curCheck[0:5] == 'Clust':
-                #append to ensemFiles
-                ensemFiles.append(direct + '/' + curCheck)
+        for curCheck in sorted(os.listdir(direct)):
+            if curCheck.endswith('.xlsx') and curCheck[0:5] in ('Ensem','Clust'):
+                ensemFiles.append(os.path.join(direct,curCheck))
+            elif curCheck.startswith('EnsembleClusters') and curCheck.endswith(('.csv','.parquet')):
+                ensemFiles.append(os.path.join(direct,curCheck))
 
+        #start the process of reading in and creating the ensemble output files (each sheet or Cluster id is a cluster). 
+        try:
+            clusterFrames = GB.readClusterFiles(ensemFiles)
+        except:
+            logging.error(': Failed to read in the cluster files!')
+            messagebox.showerror(title='Error', message="Failed to read the cluster files in the selected directory!")
+            return
+
+        #sort the reference features by retention time a single time for all of the clusters
         columnsHead = list(dataRaw.columns)
         columnFirst = columnsHead[0]
-        for i in range(len(ensemFiles)):
-            dataClust = np.ones((dataRaw.shape[0],3))
-            dataClust[:,0] = dataRaw[columnFirst]
-            dataClust[:,1] = dataRaw["rtmed"]
-            #start the process of reading in and creating the ensemble output files. 
-            try:
-                dataCur = pd.read_excel(ensemFiles[i])
-            except:
-                logging.error(': Failed to read in the excel sheet, it is recommend to upload an excel workbook with a single sheet!')
-                messagebox.showerror(title='Error', message="Failed to read the excel sheet, it is recommended to upload an excel workbook with a single sheet!")
-                return
-
-            dataMzRt = np.zeros((dataCur.shape[0],2))
-            dataMzRt[:,0] = dataCur["Identities"]
-            dataMzRt[:,1] = dataCur["rt_med"]
-
-            for j in range(dataMzRt.shape[0]):
-                #determine the location of the m/z values in the dataClust
-                locRT =  np.where(abs(dataClust[:,1]-dataMzRt[j,1]) < 0.0001)
-                if len(locRT[0]) > 1:
-                    for k in range(len(locRT[0])):
-                        if abs(dataClust[locRT[0][k],0] - dataMzRt[j,0]) < 0.0001:
-                            dataClust[locRT[0][k],2] = 0.04
-
-                elif len(locRT[0]) == 1:
-                    dataClust[locRT[0][0],2] = 0.04
-
-                else:
-                    logging.warning(': Creation of peaks to pathway files halted due to non-matching values, please make sure you have selected appropriate reference file.')
-                    return
-            #create the files that can be submitted to the csv saving file. 
-            dataOut = np.zeros((dataRaw.shape[0],3))
-
-            dataOut[:,0] = dataClust[:,0]
-            dataOut[:,1] = dataClust[:,2]
-            dataOut[:,2] = dataClust[:,1]
-
-            dataOut = pd.DataFrame(dataOut,columns=["m.z","p.value",'r.t'])
-            dataOut = dataOut.sort_values(by=["p.value"])
-
-            p2pPre = 'PeaksToPathways'
-            p2pSuf = '.csv'
-            firstCheck = p2pPre + '01' + p2pSuf
-
-            #create and/or navigate to P2PFiles folder to contain peaksToPathways output
-            if os.path.isdir('P2PFiles'):
-                os.chdir('P2PFiles')
-            else:
-                os.mkdir('P2PFiles')
-                os.chdir('P2PFiles')
-
-            chkBuffer = glob.glob("*.csv")
-            count = 1
-            if firstCheck in chkBuffer:
-                checkVal = False
-                while checkVal == False:
-                    count += 1
-                    #search the "buffer" for ensemble cluster
-                    if count < 10:
-                        #determine if the file has already been made
-                        curFileCheck = p2pPre + '0' + str(count) + p2pSuf
-                        if curFileCheck not in chkBuffer:
-                            checkVal = True
-                            p2pFile = curFileCheck
-
-                    else:
-                        curFileCheck = p2pPre + str(count) + p2pSuf
-                        if curFileCheck not in chkBuffer:
-                            checkVal = True
-                            p2pFile = curFileCheck
-                dataOut.to_csv(p2pFile, index=False)
-            else:
-                p2pFile = p2pPre + '0'+ str(count) + p2pSuf 
-                dataOut.to_csv(p2pFile, index=False)
-            logging.info(':Success!')
-
-            os.chdir('..')
+        peakIndex = GB.PeakIndex(dataRaw[columnFirst].to_numpy(dtype=float),dataRaw["rtmed"].to_numpy(dtype=float))
+
+        clusterRows = []
+        for i in range(len(clusterFrames)):
+            dataCur = clusterFrames[i]
+            rows, matched = peakIndex.match(dataCur["Identities"].to_numpy(dtype=float),dataCur["rt_med"].to_numpy(dtype=float))
+            if not np.all(matched):
+                logging.warning(': Creation of peaks to pathway files halted due to non-matching values, please make sure you have selected appropriate reference file.')
+                break
+            clusterRows.append(rows)
+
+        #save to the P2PFiles folder of the run, writing the files in parallel
+        p2pFiles = run.nextNames('PeaksToPathways','.csv',count=len(clusterRows),subDir='P2PFiles')
+        GB.peaksToPathwaysFiles(peakIndex,clusterRows,p2pFiles,numThreads=config.numThreads)
+        if len(clusterRows) < len(clusterFrames):
+            return
+        logging.info(':Success!')
         logging.info(': Leaving the Peaks to Pathways Function!')
-        os.chdir(curDir)
         messagebox.showinfo(title="Success",message="Success Peaks to Pathway files have been generated!!")
         return
 
     
-    def selectClusters(link,dist,norm=0, colOrder=[], transform = 'None', scale = 'None',cmap = 'viridis'):
+    def selectClusters(link,dist,norm=0, colOrder=[], transform = 'None', scale = 'None',cmap = 'viridis', dataset=None, run=None):
         '''
         Function that pulls out the information from the plot and saves it until the user is ready to submit the clusters to the peaks to pathways function. 
         
@@ -899,6 +668,8 @@ class GUIUtils:
         transform
         scale
         color map
+        dataset - optional Dataset (GuiBackground.loadDataset), otherwise the user is asked for a file
+        run - optional GuiBackground.OutputRun the selected cluster files are saved to
 
         Output:
         dendrogram allowing users to select clusters of interest
@@ -909,27 +680,29 @@ class GUIUtils:
         logging.info(': User called the Create Clustergram Function.')
         #check that the file the user selects is appropriate
         global metab_data
-        file = filedialog.askopenfilename()
-        metab_data = GB.readAndPreProcess(file=file,transform='None',scale='None',func='Raw')
+        if dataset is None:
+            #read the file in a single time for the raw and pre-processed data
+            file = filedialog.askopenfilename()
+            dataset = GB.loadDataset(file=file)
         
-        if metab_data is None:
+        if dataset is None:
             #log error message and return for soft exit.
             logging.error(': Error loading in the Excel sheet.')
             return  
 
+        metab_data = GB.readAndPreProcess(file=dataset,transform='None',scale='None',func='Raw')
+
         #get columns for the usage later in the creation of a dataframe to save for    
         columns = list(metab_data.columns)
-        #read in data
-        data = GB.readInColumns(metab_data)
         data_orig = metab_data.to_numpy()
         #Standardize the data before clustering the results
         logging.info(': Pre-processing the data.')
 
         #send the data off to the readAndPreProcess function for analysis. 
         if norm == 0:
-            data, col_groups = GB.readAndPreProcess(file=file,transform=transform,scale=scale,func="CC")
+            data, col_groups = GB.readAndPreProcess(file=dataset,transform=transform,scale=scale,func="CC")
         elif norm == 1:
-            data, col_groups = GB.readAndPreProcess(file=file,transform=transform,scale=scale,func="CC",first =colOrder[0])
+            data, col_groups = GB.readAndPreProcess(file=dataset,transform=transform,scale=scale,func="CC",first =colOrder[0])
 
         del(col_groups)
         #create messagebox explaining to users how they need to select clusters.
@@ -938,8 +711,9 @@ class GUIUtils:
         #Create the appropriate plt figure to allow for the comparison of linkage functions
         fig, axes = plt.subplots(1,1,figsize=(8,8))
 
-        #find the linkages
-        linkageOne = linkage(data,link,metric=dist)
+        #find the linkages (cached for the session)
+        fingerprint = GB.dataFingerprint(data)
+        linkageOne = GB.cachedLinkage(data,link,dist,fingerprint=fingerprint)
 
         if len(linkageOne[:,2]) == len(np.unique(linkageOne[:,2])):
             logging.info('No need to jitter data!')
@@ -959,11 +733,11 @@ class GUIUtils:
                     if k > 0:
                         linkageOne[curLinkListLoc[k],2] += (k*0.000001)+0.000001
 
-        groupCluster = np.transpose(data)
-        linkageG = linkage(groupCluster,link,metric=dist)
-        #create the dendrogram
-        dend = dendrogram(linkageOne,ax=axes,above_threshold_color='y',orientation='left',no_labels=True)
-        dendG = dendrogram(linkageG,ax=axes,above_threshold_color='y',orientation='left',no_labels=True)
+        linkageG = GB.cachedLinkage(data,link,dist,axis='cols',fingerprint=fingerprint)
+        #create the dendrogram (scipy's dendrogram recurses as deep as the trees)
+        with GB.recursionLimit(max(GB.linkageDepth(linkageOne),GB.linkageDepth(linkageG))):
+            dend = dendrogram(linkageOne,ax=axes,above_threshold_color='y',orientation='left',no_labels=True)
+            dendG = dendrogram(linkageG,ax=axes,above_threshold_color='y',orientation='left',no_labels=True)
         #Rework the data to create the clustergram
         metaboliteDendLeaves = dend['leaves']
         #find the maximum leaf to know what the index must be larger than for filling in the color
@@ -999,7 +773,8 @@ class GUIUtils:
             columnsNew.append(columns[groupDendLeaves[i]])
 
         dataFinalDF = pd.DataFrame(dataFinal,columns=columnsNew)
-        dataFinalDF.to_excel('Heatmap.xlsx',index=False)
+        run = GB.getOutputRun(run)
+        dataFinalDF.to_excel(run.path('Heatmap.xlsx'),index=False)
         #create the axes in which the heatmap will be mapped upon
         plt.cla()
         heatmapAxes = [0.3, 0, 0.68, 1]
@@ -1035,11 +810,14 @@ class GUIUtils:
         linkageClusters = GB.clustConnectLink(linkageOne)
 
         colSel = 0
-        open('ClustColor.txt','w').write(str(colSel))
-        open('ClusterReference.txt','w').write(str(time.strftime("%a_%b_%d_%Y_%H_%M_%S")))
-        open('ClusterReference.txt','a').write("\n"+str(len(dataFinalDF[columnsNew[0]])))
+        open(run.path('ClustColor.txt'),'w').write(str(colSel))
+        open(run.path('ClusterReference.txt'),'w').write(str(time.strftime("%a_%b_%d_%Y_%H_%M_%S")))
+        open(run.path('ClusterReference.txt'),'a').write("\n"+str(len(dataFinalDF[columnsNew[0]])))
         #create an interactive cursor
         cursor = mplcursors.cursor(multiple=True)
         cursor.visible =False
-        cursor.connect("add", lambda sel: GB.select(sel.target,dend,linkageOne,linkDir,linkageClusters,data_orig))
-        plt.show()
\ No newline at end of file
+        cursor.connect("add", lambda sel: GB.select(sel.target,dend,linkageOne,linkDir,linkageClusters,data_orig,run=run,dataset=dataset))
+        plt.show()
+
+        #wait for the selected cluster files to finish writing
+        GB.flushOutputs()
\ No newline at end of file
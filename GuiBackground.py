@@ -2,12 +2,15 @@ import numpy as np
 import statistics as stat
 from scipy.cluster.hierarchy import dendrogram
 from scipy.cluster.hierarchy import linkage
-from scipy.spatial.distance import pdist
+from scipy.spatial.distance import pdist, squareform, cdist
 from matplotlib import pyplot as plt
 import pandas as pd
 import seaborn as sns
 from tkinter import HORIZONTAL, filedialog, messagebox
-import logging, time, glob,sys,os,math, config
+import re,collections,contextlib,logging, time,sys,os,math,queue,hashlib,tempfile,weakref,zipfile,struct,threading,pickle,atexit,mmap, config
+from multiprocessing import Pool, shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from fpdf import FPDF
 
 
@@ -19,11 +22,11 @@ def fileCheck(file=''):
     Input:
 
     Does not require an input, but does accept a full file path which can be used to check for an excel sheet with 'Medians' as 
-    the sheet name. 
+    the sheet name. Excel workbooks, csv/tsv files and parquet files can be read (see readInputFile).
 
     Output:
     
-    Returns the data from the excel file. 
+    Returns the data from the file. 
     '''
     #log that the user called the Create Clustergram function
     logging.warning(': Checking file for the appropriate input.')
@@ -38,7 +41,7 @@ def fileCheck(file=''):
 
     #Open the excel file that the user to looking to use for their clustering analysis
     try:
-        data = pd.read_excel(file)
+        data = readCached(file)
         del(file)
     except:
         logging.error(': Failed to read in the excel sheet, it is recommended that an excel workbook with a single sheet is uploaded!')
@@ -49,15 +52,173 @@ def fileCheck(file=''):
 
     #send the data to the data checker
 
-    # data = dataCheck(data)
+    # data, dataMatches = dataCheck(data)
     return data
 
 
 
+def fileHash(file):
+    '''
+    Hash the contents of a file.
+
+    Input:
+    file - full path to the file
+
+    Output:
+    sha256 hex digest of the file contents.
+    '''
+    digest = hashlib.sha256()
+    with open(file,'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+#version of the parsed input, increase it whenever readInputFile gives a different DataFrame for the same file so cached entries are not reused
+inputReaderVersion = 1
+
+def inputCacheDir():
+    '''
+    Output:
+    directory of the parsed input cache, config.inputCacheDir when it is an absolute path, otherwise config.inputCacheDir within the 
+    user's cache directory (%LOCALAPPDATA%\\ECCO on Windows, $XDG_CACHE_HOME/ECCO or ~/.cache/ECCO elsewhere).
+    '''
+    cacheDir = os.path.expanduser(config.inputCacheDir)
+    if os.path.isabs(cacheDir):
+        return cacheDir
+    userCache = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'),'.cache')
+    return os.path.join(userCache,'ECCO',cacheDir)
+
+def readCached(file):
+    '''
+    Read in an input file through the parsed input cache. The parsed table is saved in a binary (pickle) file named by the hash of the
+    file contents, the file extension and inputReaderVersion, so later reads of an unchanged file skip the excel parser while changed 
+    files (or files read by a changed parser) are parsed again. The least recently used entries are removed once the cache is larger 
+    than config.inputCacheSize (MB).
+
+    Input:
+    file - full path to the input file
+
+    Output:
+    DataFrame of the input file.
+    '''
+    if not config.useInputCache:
+        return readInputFile(file)
+
+    cacheDir = inputCacheDir()
+    cacheKey = hashlib.sha256((fileHash(file) + os.path.splitext(file)[1].lower() + str(inputReaderVersion)).encode()).hexdigest()
+    cacheFile = os.path.join(cacheDir, cacheKey + '.pkl')
+    if os.path.isfile(cacheFile):
+        try:
+            data = pd.read_pickle(cacheFile)
+            #mark the entry as recently used
+            os.utime(cacheFile)
+            logging.info(': Parsed input read from the cache.')
+            return data
+        except Exception:
+            logging.warning(': Unable to read the cached input, reading the excel file instead.')
+
+    data = readInputFile(file)
+    try:
+        os.makedirs(cacheDir,exist_ok=True)
+        data.to_pickle(cacheFile)
+        trimCache(cacheDir,config.inputCacheSize*1024**2)
+    except OSError:
+        logging.warning(': Unable to save the parsed input to the cache.')
+    return data
+
+def readInputFile(file,chunkSize=100000):
+    '''
+    Read in an input file based upon its extension. Excel workbooks are read with pandas, csv (.csv) and tab separated (.tsv, .txt) files
+    are streamed in chunks and parquet (.parquet) files are read with pandas (requires pyarrow or fastparquet). Every format gives the same
+    DataFrame as reading the data from an excel workbook.
+
+    Input:
+    file - full path to the file
+
+    Optional:
+    chunkSize - number of rows of a csv/tsv file parsed at a time
+
+    Output:
+    DataFrame of the file.
+    '''
+    ext = os.path.splitext(file)[1].lower()
+    if ext in ('.csv','.tsv','.txt'):
+        sep = ',' if ext == '.csv' else '\t'
+        #read the first row separately, it contains the groups so would otherwise stop the columns being read as numbers
+        firstRow = pd.read_csv(file,sep=sep,nrows=1)
+        dtypes = {col:np.float64 for col in firstRow.columns[1:]}
+        try:
+            chunks = pd.read_csv(file,sep=sep,skiprows=[1],dtype=dtypes,chunksize=chunkSize)
+            body = pd.concat(chunks,ignore_index=True)
+        except ValueError:
+            #non-numeric values in the body, let pandas determine the column types
+            logging.warning(': Non-numeric values found in the input file, reading the file without column types.')
+            body = pd.read_csv(file,sep=sep,skiprows=[1],low_memory=False)
+        return pd.concat([firstRow,body],ignore_index=True)
+
+    elif ext == '.parquet':
+        return pd.read_parquet(file)
+
+    return pd.read_excel(file)
+
+def trimCache(cacheDir,maxSize):
+    '''
+    Remove the least recently used files from the cache directory until it is no larger than maxSize.
+
+    Input:
+    cacheDir - cache directory
+    maxSize - maximum size of the cache in bytes
+    '''
+    entries = []
+    for entry in os.scandir(cacheDir):
+        if entry.is_file():
+            entryStat = entry.stat()
+            entries.append((entryStat.st_mtime,entryStat.st_size,entry.path))
+
+    #remove the oldest entries first
+    entries.sort()
+    totalSize = sum(entry[1] for entry in entries)
+    for mtime, size, path in entries:
+        if totalSize <= maxSize:
+            break
+        os.remove(path)
+        totalSize -= size
+
 ###------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 ###-------------------------------------------------------------- DATA SCALING---------------------------------------------------------------------------------------------------------
 ###------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 
+#Each of the scaling functions scales each row (metabolite) across its columns (samples), they accept a single row or the whole matrix.
+#Float arrays are updated in place.
+
+def floatOut(data):
+    '''
+    Determine whether the data can be updated in place.
+
+    Input:
+    data - data to be updated
+
+    Output:
+    data if it is a writeable float numpy array, otherwise None (numpy then creates a new array).
+    '''
+    if isinstance(data, np.ndarray) and data.dtype.kind == 'f' and data.flags.writeable:
+        return data
+    return None
+
+def rowStats(data):
+    '''
+    Mean of each row and mask of the rows that contain a single repeated value.
+
+    Input:
+    data - single row or matrix of data
+
+    Output:
+    row means and the constant row mask (both keep the row dimension for broadcasting).
+    '''
+    data = np.asarray(data)
+    mean_data = np.mean(data,axis=-1,keepdims=True)
+    constant = np.all(data == data[...,:1],axis=-1,keepdims=True)
+    return mean_data, constant
 
 #Standardizing the data that is input to python. (Auto-scaling in Metaboanalyst)
 def standardize(data):
@@ -66,25 +227,19 @@ def standardize(data):
     
     Input:
 
-    Single row of data.
+    Single row of data or the whole matrix.
 
     Output:
 
-    Standardized single row of data. 
+    Standardized data, rows without variation are set to zero. 
 
     '''
-    #I would like to add the ability to check for the number of rows or columns that are given in a numpy array.
-    #find the mean and standard deviation of the given row(eventually will need to move this to allow for the entire table to input.)
-    mean_data = stat.mean(data)
-    std_data = stat.stdev(data)
+    mean_data, constant = rowStats(data)
+    std_data = np.std(data,axis=-1,ddof=1,keepdims=True)
 
-    dataCur = np.zeros(data.shape[0])
-    if std_data == 0:
-        for i in range(data.shape[0]):
-            dataCur[i] = 0
-    else:
-        for i in range(data.shape[0]):
-            dataCur[i] = (data[i]-mean_data)/std_data
+    dataCur = np.subtract(data,mean_data,out=floatOut(data))
+    np.divide(dataCur,std_data,out=dataCur,where=~constant)
+    np.copyto(dataCur,0,where=constant)
 
     return dataCur
 
@@ -96,9 +251,7 @@ def normStandardize(data,first):
     Input:
 
     data - all data. 
-    leaves - leaves of the groups you would like to normalize. 
-
-    ***Currently the only possible normalization is the first column of data. Will be updated soon. 
+    first - column (starting at 1) of the group you would like to normalize to. 
 
     Output:
     
@@ -107,25 +260,17 @@ def normStandardize(data,first):
     '''
 
     first = int(first)-1
-    first = int(first)
 
     logging.info(': Normalizing strandardized data.')
     #The mean for a normalized data set should always be 1 for all of the metabolites.
-    mean = data[first]
+    mean = np.asarray(data)[...,first:first+1].astype(float)
 
-    #initialize the needed arrays
-    dataCur = np.zeros(data.shape[0])
-    #Calculate the residuals of the data
-    residuals = 0
-    for j in range(data.shape[0]):
-        residuals += (data[j]-mean)**2
+    #Calculate the residuals of the data and the standard deviation around the normalizing column
+    dataCur = np.subtract(data,mean,out=floatOut(data))
+    std_data = np.sqrt(np.sum(dataCur**2,axis=-1,keepdims=True)/(dataCur.shape[-1]-1))
 
-    #calculate the standard deviation
-    std_data = (residuals/(data.shape[0]-1))**0.5
     #standardize each row of data
-    for i in range(data.shape[0]):
-        #Input the data into an array of standardized (auto-scaling in metaboanalyst) values
-        dataCur[i] = (data[i]-mean)/std_data
+    np.divide(dataCur,std_data,out=dataCur)
 
     return dataCur
 
@@ -144,12 +289,10 @@ def meanCentering(data):
     '''
 
     logging.info(': Mean-centering the data.')
-    mean_data = stat.mean(data)
-
-    dataCur = np.zeros(data.shape[0])
+    mean_data, constant = rowStats(data)
 
-    for i in range(data.shape[0]):
-        dataCur[i] = (data[i]-mean_data)
+    dataCur = np.subtract(data,mean_data,out=floatOut(data))
+    np.copyto(dataCur,0,where=constant)
     
     return dataCur
 
@@ -167,17 +310,12 @@ def paretoScaling(data):
     '''
 
     logging.info(': Pareto scaling the data.')
-    mean_data = stat.mean(data)
-    std_data = stat.stdev(data)
+    mean_data, constant = rowStats(data)
+    std_data = np.std(data,axis=-1,ddof=1,keepdims=True)
 
-    dataCur = np.zeros(data.shape[0])
-
-    if std_data == 0:
-        for i in range(data.shape[0]):
-            dataCur[i] = data[i]-mean_data
-    else:
-        for i in range(data.shape[0]):
-            dataCur[i] = (data[i]-mean_data)/(std_data**.5)
+    dataCur = np.subtract(data,mean_data,out=floatOut(data))
+    np.divide(dataCur,std_data**.5,out=dataCur,where=~constant)
+    np.copyto(dataCur,0,where=constant)
 
     return dataCur
 
@@ -194,18 +332,12 @@ def rangeScaling(data):
     Range scaled data
     '''
     logging.info(': Range scaling the data.')
-    mean_data = stat.mean(data)
-    max = np.max(data)
-    min = np.min(data)
-    rangeData = max-min
-
-    dataCur = np.zeros(data.shape[0])
-    if rangeData == 0:
-        for i in range(data.shape[0]):
-            dataCur[i] = data[i]-mean_data
-    else:
-        for i in range(data.shape[0]):
-            dataCur[i] = (data[i]-mean_data)/rangeData
+    mean_data, constant = rowStats(data)
+    rangeData = np.ptp(data,axis=-1,keepdims=True)
+
+    dataCur = np.subtract(data,mean_data,out=floatOut(data))
+    np.divide(dataCur,rangeData,out=dataCur,where=~constant)
+    np.copyto(dataCur,0,where=constant)
 
     return dataCur
 
@@ -229,10 +361,10 @@ def logTrans(data):
 
     Outputs the input data log transformed
     '''
-    #given a row of data from the data take a log transform 
+    #take a log transform of the data
     #add small amount amount to get past zeros
-    data +=0.1
-    dataUpdate = np.log10(data) 
+    dataUpdate = np.add(data,0.1,out=floatOut(data))
+    dataUpdate = np.log10(dataUpdate,out=dataUpdate)
 
     
     return dataUpdate
@@ -252,7 +384,7 @@ def sqrtTrans(data):
     Outputs the input data square root transformed
     '''
 
-    dataUpdate = np.sqrt(data)
+    dataUpdate = np.sqrt(data,out=floatOut(data))
 
     return dataUpdate
 
@@ -271,13 +403,17 @@ def cubeRtTrans(data):
     Outputs the input data cube root transformed
     '''
 
-    dataUpdate = np.cbrt(data)
+    dataUpdate = np.cbrt(data,out=floatOut(data))
 
     return dataUpdate
 
+#transformations and scalings available to the transformations function
+transformFunctions = {'Log transformation':logTrans, 'Square root transformation':sqrtTrans, 'Cube root transformation':cubeRtTrans}
+scaleFunctions = {'Mean centering':meanCentering, 'Auto Scaling':standardize, 'Pareto Scaling':paretoScaling, 'Range Scaling':rangeScaling}
+
 
 #ensemble dendrogram function
-def createEnsemDendrogram(data,metab_data,norm=1,minMetabs=0, numClusts = 13, link='ward',dist='euclidean',func="ensemble",colMap ='viridis'):
+def createEnsemDendrogram(data,metab_data,norm=1,minMetabs=0, numClusts = 13, link='ward',dist='euclidean',func="ensemble",colMap ='viridis',run=None,dataset=None):
     '''
     Create ensemble dendrogram
     
@@ -285,7 +421,7 @@ def createEnsemDendrogram(data,metab_data,norm=1,minMetabs=0, numClusts = 13, li
 
     Required:
 
-    data - co-occurence matrix
+    data - co-occurence matrix (NxN numpy array or CoOccurrence, e.g. CoOccurrence.load('EnsembleCoOcc.npz'))
     metab_data - original raw data
 
     Optional:
@@ -294,6 +430,8 @@ def createEnsemDendrogram(data,metab_data,norm=1,minMetabs=0, numClusts = 13, li
     link - input the linkage function you would like the program to use for the ensemble clustering (or final clustering)
     dist - distance measure you would like to use in the final clustering of the data. 
     func - should always be ensemble. 
+    run - OutputRun the clustergram and cluster files belong to
+    dataset - Dataset of metab_data, used to add collapsed duplicates back to the cluster files
 
 
     Output:
@@ -301,20 +439,30 @@ def createEnsemDendrogram(data,metab_data,norm=1,minMetabs=0, numClusts = 13, li
     Outputs the ensemble clustergram and sends the output to the function which generates the output files. 
 
     '''
-    #generate linkage function
-    linkageMetabOut = linkage(data,link,dist)
+    if isinstance(data, CoOccurrence):
+        #expand saved or compact counts into the normalized matrix
+        data = data.square()
+
+    #generate linkage function (cached for the session)
+    fingerprint = dataFingerprint(data)
+    linkageMetabOut = cachedLinkage(data,link,dist,fingerprint=fingerprint)
     #create the dendrogram
-    metaboliteDend = dendrogram(linkageMetabOut, orientation='left',no_plot=True)
+    with recursionLimit(linkageDepth(linkageMetabOut)):
+        metaboliteDend = dendrogram(linkageMetabOut, orientation='left',no_plot=True)
     metaboliteDendLeaves = metaboliteDend['leaves']
 
     #tranpose the data and then run an analysis on the groups.
     groupCluster = np.transpose(data)
     logging.info(': Ensemble clustergram being generated.')
 
-    #Create a linkage matrix for the data
-    linkageGroupOut = linkage(groupCluster,link,dist)
+    #Create a linkage matrix for the data, the co-occurrence matrix is symmetric so the metabolite linkage can be reused
+    if data.shape[0] == data.shape[1] and np.array_equal(data,groupCluster):
+        linkageGroupOut = linkageMetabOut.copy()
+    else:
+        linkageGroupOut = cachedLinkage(data,link,dist,axis='cols',fingerprint=fingerprint)
     #create the dendrogram of the output
-    groupDend = dendrogram(linkageGroupOut,orientation='top',no_plot=True)
+    with recursionLimit(linkageDepth(linkageGroupOut)):
+        groupDend = dendrogram(linkageGroupOut,orientation='top',no_plot=True)
     #get the leaves of the dendrogram to allow for the appropriate regrouping of the data
     groupDendLeaves = groupDend['leaves']
 
@@ -328,17 +476,19 @@ def createEnsemDendrogram(data,metab_data,norm=1,minMetabs=0, numClusts = 13, li
 
 
 
-    g = sns.clustermap(data, figsize=(7, 5), yticklabels=False, xticklabels=False, row_linkage=linkageMetabOut, col_linkage=linkageGroupOut, cmap=colMap, cbar_pos=(0.01, 0.8, 0.025, 0.175))
+    with recursionLimit(max(linkageDepth(linkageMetabOut),linkageDepth(linkageGroupOut))):
+        g = sns.clustermap(data, figsize=(7, 5), yticklabels=False, xticklabels=False, row_linkage=linkageMetabOut, col_linkage=linkageGroupOut, cmap=colMap, cbar_pos=(0.01, 0.8, 0.025, 0.175), rasterized=True)
     ax = g.ax_heatmap
     axD = g.ax_row_dendrogram
 
     
-    recClusters(dataFinal,ax,groupDendLeaves,metab_data,minMetabs,numClusts)
-    plt.savefig('EnsembleClustergram01.png',dpi=600,transparent=True)
+    run = getOutputRun(run)
+    recClusters(dataFinal,ax,groupDendLeaves,metab_data,minMetabs,numClusts,run=run,dataset=dataset)
+    getOutputWriter().saveFigure(plt.gcf(),run.path('EnsembleClustergram01.png'),dpi=600,transparent=True)
     plt.show()
 
 #dendrogram function
-def create_dendrogram(data, col_groups, norm=1,colOrder =[], link='ward',dist='euclidean', color='viridis'):
+def create_dendrogram(data, col_groups, norm=1,colOrder =[], link='ward',dist='euclidean', color='viridis',run=None):
     '''
     Create dendrogram for either the ensemble or clustergram functions
 
@@ -354,14 +504,12 @@ def create_dendrogram(data, col_groups, norm=1,colOrder =[], link='ward',dist='e
     link - input string of wanted linkage function. 
     dist - input string of wanted distance measure.
     func - 'clustergram' -> do not change the argument. 
+    run - OutputRun the clustergram belongs to
 
     Output:
 
     This function outputs a clustergram using the seaborn clustermap function 
     '''
-    #increase recursion limit
-    sys.setrecursionlimit(10**8)
-
     #set out color options and map to the groups. 
     colorOpts = ('b','y','m','r','k','#929292')
     
@@ -377,25 +525,23 @@ def create_dendrogram(data, col_groups, norm=1,colOrder =[], link='ward',dist='e
     col_groups = colSeries.to_list()
     
 
-    #Create the linkage matrix
-    linkageMetabOut = linkage(data,link,dist)
+    #Create the linkage matrix (cached for the session)
+    fingerprint = dataFingerprint(data)
+    linkageMetabOut = cachedLinkage(data,link,dist,fingerprint=fingerprint)
 
-    #tranpose the data and then run an analysis on the groups.
-    try:
-        groupCluster = np.transpose(data)
-        logging.info(': Clustergram being generated.')
-    except:
-        logging.error(': Inappropriate entry for the create_dendrogram function. Check docs.')
-        messagebox.showerror(title ='Error' ,message='Inappropriate entry for the create_dendrogram function. Check docs.')
+    logging.info(': Clustergram being generated.')
 
-    #Create a linkage matrix for the data
-    linkageGroupOut = linkage(groupCluster,link,dist)
+    #Create a linkage matrix for the data (the groups are only clustered in the standard clustergram)
+    if norm == 0:
+        linkageGroupOut = cachedLinkage(data,link,dist,axis='cols',fingerprint=fingerprint)
 
     
+    #seaborn draws the dendrograms with scipy's recursive dendrogram, so allow recursion as deep as the metabolite tree (only while plotting)
+    #the precomputed linkages are passed to seaborn so it does not cluster the data again
     if norm == 0:
-        #g = sns.clustermap(data, figsize=(7, 5), row_linkage=linkageMetabOut, col_linkage=linkageGroupOut, cmap=color, cbar_pos=(0.01, 0.8, 0.025, 0.175))
-        g = sns.clustermap(data, method=link,metric=dist, figsize=(7, 5), col_cluster=True,col_colors=col_groups,cmap=color,yticklabels=False,xticklabels=True)
-        plt.savefig('Clustergram.png',dpi=600,transparent=True)
+        with recursionLimit(linkageDepth(linkageMetabOut)):
+            g = sns.clustermap(data, row_linkage=linkageMetabOut, col_linkage=linkageGroupOut, figsize=(7, 5), col_cluster=True,col_colors=col_groups,cmap=color,yticklabels=False,xticklabels=True,rasterized=True)
+        getOutputWriter().saveFigure(plt.gcf(),getOutputRun(run).path('Clustergram.png'),dpi=600,transparent=True)
         plt.show()
 
     elif norm == 1:
@@ -405,8 +551,10 @@ def create_dendrogram(data, col_groups, norm=1,colOrder =[], link='ward',dist='e
         col_groups = [col_groups[i] for i in colOrder]
 
         data[:,:] = data[:,colOrder]
-        g = sns.clustermap(data,method=link,metric=dist,figsize=(7,5), col_cluster=False,cmap=color,col_colors=col_groups,yticklabels=False,xticklabels=False)
-        plt.savefig('Clustergram.png',dpi=600,transparent=True)
+        #reordering the columns does not change the distances between metabolites, so the metabolite linkage is still valid
+        with recursionLimit(linkageDepth(linkageMetabOut)):
+            g = sns.clustermap(data,row_linkage=linkageMetabOut,figsize=(7,5), col_cluster=False,cmap=color,col_colors=col_groups,yticklabels=False,xticklabels=False,rasterized=True)
+        getOutputWriter().saveFigure(plt.gcf(),getOutputRun(run).path('Clustergram.png'),dpi=600,transparent=True)
         plt.show()
 
     elif norm == 2:
@@ -416,12 +564,44 @@ def create_dendrogram(data, col_groups, norm=1,colOrder =[], link='ward',dist='e
         col_groups = [col_groups[i] for i in colOrder]
 
         data[:,:] = data[:,colOrder]
-        g = sns.clustermap(data,method=link,metric=dist,figsize=(7,5), col_cluster=False,cmap=color,col_colors=col_groups,yticklabels=False,xticklabels=False)
-        plt.savefig('Clustergram.png',dpi=600,transparent=True)
+        #reordering the columns does not change the distances between metabolites, so the metabolite linkage is still valid
+        with recursionLimit(linkageDepth(linkageMetabOut)):
+            g = sns.clustermap(data,row_linkage=linkageMetabOut,figsize=(7,5), col_cluster=False,cmap=color,col_colors=col_groups,yticklabels=False,xticklabels=False,rasterized=True)
+        getOutputWriter().saveFigure(plt.gcf(),getOutputRun(run).path('Clustergram.png'),dpi=600,transparent=True)
         plt.show()
 
         
 
+def linkageDepth(linkageMatrix):
+    '''
+    Input:
+    linkageMatrix - scipy linkage output
+
+    Output:
+    number of levels in the tree of the linkage (the recursion depth needed by scipy's dendrogram).
+    '''
+    numLeaves = linkageMatrix.shape[0] + 1
+    children = linkageMatrix[:,:2].astype(int)
+    depth = np.zeros(2*numLeaves-1,dtype=int)
+    for i in range(numLeaves-1):
+        depth[numLeaves+i] = 1 + max(depth[children[i,0]],depth[children[i,1]])
+    return int(depth[-1])
+
+@contextlib.contextmanager
+def recursionLimit(depth):
+    '''
+    Raise the recursion limit (if needed) to allow depth more nested calls than the current stack, the limit is restored afterwards.
+
+    Input:
+    depth - number of nested calls needed
+    '''
+    oldLimit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(oldLimit,depth+1000))
+    try:
+        yield
+    finally:
+        sys.setrecursionlimit(oldLimit)
+
 def cooccurrence(data):
     '''
     Creation of the cooccurrence matrix for the determination of the number times each set of metabolites is clustered together
@@ -449,46 +629,724 @@ def cooccurrence(data):
 
     return coOcc
 
-def popCooccurrence(clusters,coOcc,numClusterings):
+class CoOccurrence:
+    '''
+    Compact co-occurrence matrix for ensemble clustering. The number of times each pair of metabolites is clustered together is stored as an
+    integer count in the condensed upper triangle (same ordering as scipy's pdist), using the smallest unsigned integer type that can hold
+    numClusterings. The normalized float matrix is only created when requested.
+
+    Input:
+    numMetabs - number of metabolites being clustered.
+    numClusterings - number of clusterings in the ensemble.
+
+    Optional:
+    counts - existing condensed counts (see load)
+    '''
+
+    def __init__(self,numMetabs,numClusterings,counts=None):
+        self.numMetabs = int(numMetabs)
+        self.numClusterings = int(numClusterings)
+        if counts is not None:
+            self.counts = counts
+            return
+
+        #find the smallest integer type that can count every clustering
+        for dtype in (np.uint8,np.uint16,np.uint32):
+            if self.numClusterings <= np.iinfo(dtype).max:
+                break
+        self.counts = np.zeros(self.numMetabs*(self.numMetabs-1)//2,dtype=dtype)
+
+    @property
+    def shape(self):
+        return (self.numMetabs,self.numMetabs)
+
+    def add(self,labels,tileSize=2048):
+        '''
+        Add one clustering to the counts.
+
+        Input:
+        labels - label array of the clustering (see linkageLabels)
+
+        Optional:
+        tileSize - the number of pairs handled at once is limited to tileSize x tileSize.
+        '''
+        labels = np.asarray(labels)
+        numMetabs = self.numMetabs
+        maxPairs = max(int(tileSize),1)**2
+
+        #only clusters with more than one metabolite add to the counts
+        order = np.argsort(labels,kind='stable')
+        bounds = np.flatnonzero(np.diff(labels[order]))+1
+        for members in np.split(order,bounds):
+            lenMembers = len(members)
+            if lenMembers < 2:
+                continue
+            members = np.sort(members).astype(np.int64)
+            rowsPerTile = max(maxPairs//lenMembers,1)
+            for k in range(0,lenMembers-1,rowsPerTile):
+                rows = members[k:k+rowsPerTile,None]
+                cols = members[None,:]
+                upper = cols > rows
+                #location of each (row, col) pair within the condensed upper triangle
+                condensed = numMetabs*rows - rows*(rows+1)//2 + (cols-rows-1)
+                self.counts[condensed[upper]] += 1
+        return self
+
+    def condensed(self):
+        '''
+        Output:
+        condensed float64 array of the fraction of clusterings each pair was clustered together.
+        '''
+        return self.counts/self.numClusterings
+
+    def square(self):
+        '''
+        Output:
+        NxN float64 co-occurrence matrix, matching the output of cooccurrence and popCooccurrence.
+        '''
+        coOcc = squareform(self.condensed())
+        np.fill_diagonal(coOcc,1)
+        return coOcc
+
+    def save(self,file,compress=False):
+        '''
+        Save the counts to a .npz file.
+
+        Input:
+        file - file name, e.g. EnsembleCoOcc.npz
+
+        Optional:
+        compress - compress the counts (smaller file), only uncompressed files can be memory-mapped by load.
+        '''
+        saveFunc = np.savez_compressed if compress else np.savez
+        saveFunc(file,counts=self.counts,numMetabs=self.numMetabs,numClusterings=self.numClusterings)
+
+    @classmethod
+    def load(cls,file,mmap=True):
+        '''
+        Open a co-occurrence matrix saved with save, for example to re-run createEnsemDendrogram without recomputing the ensemble.
+
+        Input:
+        file - .npz file written by save
+
+        Optional:
+        mmap - memory-map the counts of uncompressed files instead of reading them in.
+
+        Output:
+        CoOccurrence
+        '''
+        with np.load(file) as saved:
+            numMetabs = int(saved['numMetabs'])
+            numClusterings = int(saved['numClusterings'])
+            with zipfile.ZipFile(file) as zf:
+                info = zf.getinfo('counts.npy')
+            if mmap and info.compress_type != zipfile.ZIP_STORED:
+                logging.warning(': ' + str(file) + ' is compressed and cannot be memory-mapped, reading the co-occurrence counts into memory.')
+                mmap = False
+            if not mmap:
+                return cls(numMetabs,numClusterings,counts=saved['counts'])
+
+        #find the start of the stored counts array within the zip file and map it
+        with open(file,'rb') as f:
+            f.seek(info.header_offset)
+            localHeader = f.read(30)
+            nameLen, extraLen = struct.unpack('<HH',localHeader[26:30])
+            f.seek(info.header_offset+30+nameLen+extraLen)
+            version = np.lib.format.read_magic(f)
+            if version == (1,0):
+                shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        counts = np.memmap(file,dtype=dtype,mode='r',offset=offset,shape=shape)
+        return cls(numMetabs,numClusterings,counts=counts)
+
+def popCooccurrence(clusters,coOcc,numClusterings,tileSize=2048):
     '''
     Populate the cooccurrence matrix with the connections for each matrix based upon the number of clusterings that occur. 
     
     Input:
 
-    clusters - dictionary containing the clusters from clustering (link-dist)
-    coOcc - pass the current version of the cooccurence matrix. 
+    clusters - label array from linkageLabels, or dictionary containing the clusters from clustering (link-dist)
+    coOcc - pass the current version of the cooccurence matrix (NxN numpy array or CoOccurrence). 
     numClusterings - pass integer of the optimal number clusters. 
 
+    Optional:
+    tileSize - number of rows and columns compared at once, the working set is tileSize x tileSize. 
+
     Output:
     
     Updated NxN cooccurence matrix. 
     '''
     logging.info(': Populating the co-occurrence matrix.')
-    dictKeys = list(clusters.keys())
-    dictKeys = len(dictKeys)
+    numMetabs = coOcc.shape[0]
+    if isinstance(clusters, dict):
+        labels = clustersToLabels(clusters,numMetabs)
+    else:
+        labels = np.asarray(clusters)
+
+    if isinstance(coOcc, CoOccurrence):
+        #compact matrices store counts, the weight is applied when the matrix is normalized
+        return coOcc.add(labels,tileSize=tileSize)
 
     #weight to be added to the matrix
     weight = 1/numClusterings
+    tileSize = max(int(tileSize),1)
+
+    #compare the labels block by block and add the weight wherever two metabolites share a cluster
+    for i in range(0,numMetabs,tileSize):
+        rowLabels = labels[i:i+tileSize]
+        for j in range(0,numMetabs,tileSize):
+            sameCluster = rowLabels[:,None] == labels[None,j:j+tileSize]
+            if i == j:
+                #the diagonal is populated by cooccurrence
+                np.fill_diagonal(sameCluster,False)
+            coOcc[i:i+tileSize,j:j+tileSize] += weight*sameCluster
+    return coOcc
 
-    #populate the coOccurence matrix with the appropriate values based upon the keys using the binary operation +=
-    for i in range(dictKeys):
-        #get the first entry from the dictionary 
-        curCluster = clusters[i]
+def clustersToLabels(clusters,numMetabs):
+    '''
+    Convert a dictionary of clusters (see clustConnectLink) into a label array.
 
-        #check for a list of metabolites clustered together.
-        if isinstance(curCluster, list):
-            #determine the length of the list
-            lenList = len(curCluster)
-            
-            for j in range(lenList):
-                #populate the Cooccurrence matrix
-                remList = lenList-j
-                if remList > 1:
-                    for k in range(j+1,lenList):
-                        #add the weight to the coOcc matrix. 
-                        coOcc[curCluster[j],curCluster[k]] += weight
-                        coOcc[curCluster[k],curCluster[j]] += weight
-    return coOcc
+    Input:
+    clusters - dictionary containing lists of metabolites or single metabolites
+    numMetabs - total number of metabolites
+
+    Output:
+    int32 numpy array with the cluster label of each metabolite, metabolites not in the dictionary receive their own label.
+    '''
+    labels = np.arange(numMetabs,dtype=np.int32)
+    for key in clusters:
+        curCluster = clusters[key]
+        if isinstance(curCluster, list) and len(curCluster) > 0:
+            #label every member with the first member of the cluster
+            labels[curCluster] = curCluster[0]
+    return labels
+
+def dataFingerprint(data):
+    '''
+    Input:
+    data - numpy array
+
+    Output:
+    hash of the shape, data type and values of the array (used as the dataset part of the linkage cache keys).
+    '''
+    data = np.ascontiguousarray(data)
+    dataHash = hashlib.blake2b(digest_size=16)
+    dataHash.update((str(data.shape) + str(data.dtype)).encode())
+    dataHash.update(data.reshape(-1).view(np.uint8))
+    return dataHash.hexdigest()
+
+class LinkageCache:
+    '''
+    Least recently used cache of linkage matrices for the session, so the same linkage of the same pre-processed data is not
+    recomputed when a dataset is explored with several functions. The keys are (fingerprint of the pre-processed data, linkage 
+    function, distance metric, axis), where the fingerprint covers the dataset, transform, scale and normalization. Minimum spanning
+    trees are kept under the linkage function 'mst'.
+
+    Input:
+    maxBytes - size limit of the cached linkage matrices in bytes
+    '''
+
+    def __init__(self,maxBytes):
+        self.maxBytes = maxBytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self,key):
+        '''
+        Output:
+        copy of the cached linkage matrix, None if the key is not cached.
+        '''
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key].copy()
+
+    def put(self,key,linkageMatrix):
+        '''
+        Cache a copy of a linkage matrix, removing the least recently used matrices once the size limit is reached.
+        '''
+        linkageMatrix = np.array(linkageMatrix,copy=True)
+        if linkageMatrix.nbytes > self.maxBytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key).nbytes
+            self.entries[key] = linkageMatrix
+            self.size += linkageMatrix.nbytes
+            while self.size > self.maxBytes:
+                oldKey, oldMatrix = self.entries.popitem(last=False)
+                self.size -= oldMatrix.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+linkageCache = None
+
+def getLinkageCache():
+    '''
+    Output:
+    the LinkageCache of the session (created on first use with a limit of config.linkageCacheSize MB).
+    '''
+    global linkageCache
+    if linkageCache is None:
+        linkageCache = LinkageCache(config.linkageCacheSize*1024**2)
+    return linkageCache
+
+def cachedLinkage(data,link,dist,axis='rows',fingerprint=None):
+    '''
+    Linkage of the rows (metabolites) or columns (samples) of data, taken from the session cache when it has been computed before.
+
+    Input:
+    data - pre-processed data
+    link - linkage function
+    dist - distance metric
+
+    Optional:
+    axis - 'rows' to cluster the rows of data, 'cols' to cluster the columns (the transposed data)
+    fingerprint - dataFingerprint of data, computed when not given
+
+    Output:
+    scipy linkage output (a copy that can be changed by the caller)
+    '''
+    cache = getLinkageCache()
+    if fingerprint is None:
+        fingerprint = dataFingerprint(data)
+    key = (fingerprint,link,dist,axis)
+    linkageMatrix = cache.get(key)
+    if linkageMatrix is None:
+        if axis == 'cols':
+            linkageMatrix = linkage(np.transpose(data),link,dist)
+        else:
+            linkageMatrix = linkage(data,link,dist)
+        cache.put(key,linkageMatrix)
+    return linkageMatrix
+
+def primEdges(distanceRow,numMetabs):
+    '''
+    Minimum spanning tree of the metabolites using Prim's algorithm, the tree is grown from metabolite 0 and only the distances from the
+    newest tree member to the metabolites outside the tree are needed at each step, so no more than O(N) memory is used.
+
+    Input:
+    distanceRow - function taking (newest tree member, index array of the metabolites outside the tree) and returning their distances
+    numMetabs - number of metabolites
+
+    Output:
+    (N-1)x3 numpy array of the tree edges (index1, index2, dist) sorted by distance.
+    '''
+    edges = np.zeros((max(numMetabs-1,0),3))
+    if numMetabs < 2:
+        return edges
+
+    #metabolites outside the tree, with their closest distance to the tree and the tree member it belongs to
+    remaining = np.arange(1,numMetabs,dtype=np.int64)
+    closest = np.full(numMetabs-1,np.inf)
+    parent = np.zeros(numMetabs-1,dtype=np.int64)
+    newest = 0
+    for i in range(numMetabs-1):
+        curDists = distanceRow(newest,remaining)
+        closer = curDists < closest
+        closest[closer] = curDists[closer]
+        parent[closer] = newest
+
+        #add the closest metabolite to the tree
+        nearest = np.argmin(closest)
+        newest = remaining[nearest]
+        edges[i,:] = parent[nearest], newest, closest[nearest]
+        remaining = np.delete(remaining,nearest)
+        closest = np.delete(closest,nearest)
+        parent = np.delete(parent,nearest)
+
+    return edges[np.argsort(edges[:,2],kind='mergesort')]
+
+def mstEdges(dists,numMetabs):
+    '''
+    Minimum spanning tree of the metabolites using Prim's algorithm directly over the condensed distances (no NxN matrix is created).
+
+    Input:
+    dists - condensed distances of the metabolites (pdist output)
+    numMetabs - number of metabolites
+
+    Output:
+    sorted tree edges (see primEdges)
+    '''
+    #position of the (i,j) distance in the condensed distances is rowStarts[i]+j for i < j
+    metabs = np.arange(numMetabs,dtype=np.int64)
+    rowStarts = numMetabs*metabs - metabs*(metabs+1)//2 - metabs - 1
+
+    def distanceRow(newest,remaining):
+        return dists[np.where(remaining < newest, rowStarts[remaining]+newest, rowStarts[newest]+remaining)]
+
+    return primEdges(distanceRow,numMetabs)
+
+def mstEdgesRows(data,dist='euclidean'):
+    '''
+    Minimum spanning tree of the rows (metabolites) of data using Prim's algorithm, computing one row of distances at a time instead of
+    the condensed distances. Memory beyond the data is O(N), so the tree can be found for data sets whose distances do not fit in memory.
+
+    Input:
+    data - pre-processed data (can be memory-mapped)
+
+    Optional:
+    dist - distance metric (any scipy cdist metric)
+
+    Output:
+    sorted tree edges (see primEdges)
+    '''
+    #metrics using statistics of the whole data set get them from all of the rows, as pdist does
+    kwargs = {}
+    if dist == 'seuclidean':
+        kwargs['V'] = np.var(data,axis=0,ddof=1)
+    elif dist == 'mahalanobis':
+        kwargs['VI'] = np.linalg.inv(np.cov(np.transpose(data))).T
+
+    def distanceRow(newest,remaining):
+        return cdist(data[newest:newest+1],data,dist,**kwargs)[0,remaining]
+
+    return primEdges(distanceRow,data.shape[0])
+
+def mstLinkage(edges):
+    '''
+    Single linkage of the metabolites from their minimum spanning tree, merging the clusters joined by each edge in order of distance.
+
+    Input:
+    edges - sorted minimum spanning tree edges (primEdges output)
+
+    Output:
+    scipy linkage output
+    '''
+    numMetabs = edges.shape[0]+1
+    linkageMatrix = np.zeros((numMetabs-1,4))
+
+    #union-find over the metabolites, the root of each tree records the cluster number in the linkage output and its size
+    parent = list(range(numMetabs))
+    clusterIds = list(range(numMetabs))
+    sizes = [1]*numMetabs
+    for i, (metab1, metab2, dist) in enumerate(edges.tolist()):
+        roots = []
+        for node in (int(metab1),int(metab2)):
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            roots.append(node)
+        root1, root2 = roots
+        cluster1, cluster2 = sorted((clusterIds[root1],clusterIds[root2]))
+        sizes[root1] += sizes[root2]
+        parent[root2] = root1
+        clusterIds[root1] = numMetabs+i
+        linkageMatrix[i,:] = cluster1, cluster2, dist, sizes[root1]
+
+    return linkageMatrix
+
+def cachedMST(data,dist='euclidean',fingerprint=None,dists=None):
+    '''
+    Minimum spanning tree of the rows (metabolites) of data, taken from the session cache when it has been computed before. The tree is
+    shared by MST cluster validation and the single linkage members of ensemble clustering.
+
+    Input:
+    data - pre-processed data
+
+    Optional:
+    dist - distance metric
+    fingerprint - dataFingerprint of data, computed when not given
+    dists - condensed distances of data for dist, when not given the distances are computed a row at a time (see mstEdgesRows)
+
+    Output:
+    sorted minimum spanning tree edges (primEdges output, a copy that can be changed by the caller)
+    '''
+    cache = getLinkageCache()
+    if fingerprint is None:
+        fingerprint = dataFingerprint(data)
+    key = (fingerprint,'mst',dist,'rows')
+    edges = cache.get(key)
+    if edges is None:
+        if dists is None:
+            edges = mstEdgesRows(data,dist)
+        else:
+            edges = mstEdges(dists,data.shape[0])
+        cache.put(key,edges)
+    return edges
+
+def mstPartitions(edges,clusterRange):
+    '''
+    Replay the sorted minimum spanning tree edges through a union-find, yielding the partition of the metabolites at each requested level
+    of the single linkage hierarchy. Only the union-find (O(N)) is kept between levels.
+
+    Input:
+    edges - sorted minimum spanning tree edges (primEdges output)
+    clusterRange - iterable of the numbers of clusters wanted (e.g., range(101,0,-1))
+
+    Output:
+    yields (number of clusters, int32 label array) for each level from the most to the fewest clusters.
+    '''
+    numMetabs = edges.shape[0]+1
+    clusterRange = sorted(set(int(k) for k in clusterRange),reverse=True)
+    if len(clusterRange) == 0:
+        return
+    if clusterRange[-1] < 1 or clusterRange[0] > numMetabs:
+        logging.error(': Number of clusters requested is outside the range of the minimum spanning tree.')
+        raise ValueError('numbers of clusters must be between 1 and ' + str(numMetabs))
+
+    parent = list(range(numMetabs))
+    merged = 0
+    for numClusters in clusterRange:
+        #join the metabolites connected by the edges between the previous level and the current level
+        numMerges = numMetabs-numClusters
+        for metab1, metab2 in edges[merged:numMerges,:2].astype(np.int64).tolist():
+            roots = []
+            for node in (metab1,metab2):
+                while parent[node] != node:
+                    parent[node] = parent[parent[node]]
+                    node = parent[node]
+                roots.append(node)
+            parent[max(roots)] = min(roots)
+        merged = numMerges
+
+        roots = linkageRoots(np.asarray(parent))
+        labels = np.unique(roots,return_inverse=True)[1]
+        yield numClusters, labels.astype(np.int32)
+
+def mstLabels(edges,numClusters):
+    '''
+    Partition of the metabolites into numClusters clusters rebuilt from the sorted minimum spanning tree edges (see mstPartitions).
+
+    Output:
+    int32 label array of the partition
+    '''
+    return next(mstPartitions(edges,[numClusters]))[1]
+
+def ensembleMemberInit(shmName,shape,dtype,mmapFile=None):
+    '''
+    Pool initializer for the ensemble workers, attaches the pre-processed data placed in shared memory by ensembleMembers.
+
+    Input:
+    shmName - name of the shared memory block
+    shape - shape of the data
+    dtype - data type of the data
+
+    Optional:
+    mmapFile - .npy file of memory-mapped data, attached instead of the shared memory block
+    '''
+    global ensembleShm, ensembleData
+    if mmapFile is not None:
+        ensembleShm = None
+        ensembleData = np.load(mmapFile,mmap_mode='r')
+        return
+    ensembleShm = shared_memory.SharedMemory(name=shmName)
+    ensembleData = np.ndarray(shape,dtype=dtype,buffer=ensembleShm.buf)
+
+def ensembleLinkage(data,dists,link,dist):
+    '''
+    Create the linkage for an ensemble member, reusing the condensed distances of its distance metric when they are available.
+
+    Input:
+    data - pre-processed data
+    dists - condensed distances of data for dist (pdist output), or None
+    link - linkage function
+    dist - distance metric
+
+    Output:
+    scipy linkage output and the minimum spanning tree edges of single linkage members (None for the other members)
+    '''
+    #ward, centroid and median need the raw data to check the metric is euclidean
+    if dists is None or (link in ('ward','centroid','median') and dist != 'euclidean'):
+        return linkage(data,link,dist), None
+    if link == 'single':
+        #single linkage is the sorted minimum spanning tree, which is kept for MST validation
+        edges = mstEdges(dists,data.shape[0])
+        return mstLinkage(edges), edges
+    return linkage(dists,link), None
+
+def ensembleDistance(params):
+    '''
+    Compute the condensed distances of the shared data for one distance metric into a shared memory block.
+
+    Input:
+    params - tuple of (distance metric, name of the shared memory block for the distances)
+
+    Output:
+    the distance metric
+    '''
+    dist, shmName = params
+    numMetabs = ensembleData.shape[0]
+    shm = shared_memory.SharedMemory(name=shmName)
+    try:
+        dists = np.ndarray((numMetabs*(numMetabs-1)//2,),dtype=np.float64,buffer=shm.buf)
+        pdist(ensembleData,dist,out=dists)
+        del(dists)
+    finally:
+        shm.close()
+    return dist
+
+def ensembleMember(params):
+    '''
+    Cluster the shared data with a single linkage function and distance metric of the ensemble.
+
+    Input:
+    params - tuple of (linkage function, distance metric, optimum number of clusters, name of the shared memory block holding the
+    distances from ensembleDistance or None)
+
+    Output:
+    tuple of the linkage function, distance metric, the int32 label array of the partition, the linkage output and the minimum spanning
+    tree edges (None unless the member is single linkage).
+    '''
+    link, dist, optNum, shmName = params
+    if shmName is None:
+        linkCur, edges = ensembleLinkage(ensembleData,None,link,dist)
+    else:
+        numMetabs = ensembleData.shape[0]
+        shm = shared_memory.SharedMemory(name=shmName)
+        try:
+            dists = np.ndarray((numMetabs*(numMetabs-1)//2,),dtype=np.float64,buffer=shm.buf)
+            linkCur, edges = ensembleLinkage(ensembleData,dists,link,dist)
+            del(dists)
+        finally:
+            shm.close()
+    return link, dist, linkageLabels(linkCur,optNum), linkCur, edges
+
+def ensembleMembers(data,linkParams,optNum,numThreads=1,cache=None):
+    '''
+    Generate the partitions of each ensemble member, spreading the members over a pool of numThreads processes. The data is placed in
+    shared memory once (memory-mapped data is attached from its file) rather than being sent to the workers with every member, and the distances for each distance metric are computed
+    once and shared by every linkage function that uses the metric. At most numThreads distance blocks are held in shared memory at once,
+    each block is freed as soon as the last member using it is finished.
+
+    Input:
+    data - pre-processed data
+    linkParams - list of [linkage function, distance metric] pairs
+    optNum - optimum number of clusters
+
+    Optional:
+    numThreads - number of processes to use (config.numThreads)
+    cache - LinkageCache, members already in the cache are not recomputed and new linkages are added to it. Single linkage members are
+    built from a cached minimum spanning tree (e.g., from MST validation) when there is one, and add their tree to the cache.
+
+    Output:
+    yields (linkage function, distance metric, label array) for each member in the order the members finish. A RuntimeError is raised if
+    a worker process is killed (e.g., out of memory).
+    '''
+    if cache is not None:
+        fingerprint = dataFingerprint(data)
+
+    #group the linkage functions by distance metric
+    metricLinks = {}
+    numMembers = 0
+    for i in range(len(linkParams)):
+        link, dist = linkParams[i][0], linkParams[i][1]
+        if cache is not None:
+            linkCur = cache.get((fingerprint,link,dist,'rows'))
+            if linkCur is None and link == 'single':
+                edges = cache.get((fingerprint,'mst',dist,'rows'))
+                if edges is not None:
+                    linkCur = mstLinkage(edges)
+                    cache.put((fingerprint,link,dist,'rows'),linkCur)
+            if linkCur is not None:
+                yield link, dist, linkageLabels(linkCur,optNum)
+                continue
+        metricLinks.setdefault(dist,[]).append(link)
+        numMembers += 1
+    if numMembers == 0:
+        return
+    numThreads = min(int(numThreads),numMembers)
+
+    if numThreads <= 1:
+        #run the members in this process, one distance metric at a time
+        for dist in metricLinks:
+            dists = pdist(data,dist)
+            for link in metricLinks[dist]:
+                linkCur, edges = ensembleLinkage(data,dists,link,dist)
+                if cache is not None:
+                    cache.put((fingerprint,link,dist,'rows'),linkCur)
+                    if edges is not None:
+                        cache.put((fingerprint,'mst',dist,'rows'),edges)
+                yield link, dist, linkageLabels(linkCur,optNum)
+            del(dists)
+        return
+
+    numDists = data.shape[0]*(data.shape[0]-1)//2
+    distShms = {}
+    futures = {}
+    if isinstance(data, np.memmap) and data.filename is not None and os.path.isfile(data.filename):
+        #memory-mapped data is attached by the workers from its file
+        data.flush()
+        shm = None
+        initargs = (None,data.shape,data.dtype,data.filename)
+    else:
+        #copy the data into shared memory once for all of the workers
+        data = np.ascontiguousarray(data)
+        shm = shared_memory.SharedMemory(create=True,size=max(data.nbytes,1))
+        initargs = (shm.name,data.shape,data.dtype)
+    try:
+        if shm is not None:
+            sharedData = np.ndarray(data.shape,dtype=data.dtype,buffer=shm.buf)
+            sharedData[:] = data
+            del(sharedData)
+
+        #start the resource tracker before the workers so the workers share it with this process (the distance blocks are created later)
+        if os.name == 'posix':
+            resource_tracker.ensure_running()
+        remaining = {dist:len(metricLinks[dist]) for dist in metricLinks}
+        pending = list(metricLinks)
+
+        with ProcessPoolExecutor(max_workers=numThreads,initializer=ensembleMemberInit,initargs=initargs) as p:
+            def dispatchDistances():
+                #create a metric's distance block only when its distances are computed, at most numThreads blocks are kept at once
+                while pending and len(distShms) < numThreads:
+                    dist = pending.pop(0)
+                    distShms[dist] = shared_memory.SharedMemory(create=True,size=max(numDists*8,1))
+                    futures[p.submit(ensembleDistance,(dist,distShms[dist].name))] = 'dist'
+
+            try:
+                #compute each metric's distances in the workers, the members are submitted once the distances are ready
+                dispatchDistances()
+                while numMembers > 0:
+                    done = wait(futures,return_when=FIRST_COMPLETED)[0]
+                    for future in done:
+                        kind = futures.pop(future)
+                        try:
+                            out = future.result()
+                        except BrokenProcessPool as err:
+                            raise RuntimeError('An ensemble worker process exited unexpectedly (possibly out of memory), ensemble clustering stopped.') from err
+                        if kind == 'dist':
+                            for link in metricLinks[out]:
+                                futures[p.submit(ensembleMember,(link,out,optNum,distShms[out].name))] = 'member'
+                            continue
+
+                        numMembers -= 1
+                        if cache is not None:
+                            cache.put((fingerprint,out[0],out[1],'rows'),out[3])
+                            if out[4] is not None:
+                                cache.put((fingerprint,'mst',out[1],'rows'),out[4])
+                        yield out[:3]
+
+                        #free the distances once every member using them is finished
+                        dist = out[1]
+                        remaining[dist] -= 1
+                        if remaining[dist] == 0:
+                            distShm = distShms.pop(dist)
+                            distShm.close()
+                            distShm.unlink()
+                            dispatchDistances()
+            finally:
+                #do not start the members still waiting when stopping early
+                for future in futures:
+                    future.cancel()
+    finally:
+        for distShm in distShms.values():
+            distShm.close()
+            distShm.unlink()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
 
 def clustConnectLink(linkageCheck):
     '''
@@ -710,156 +1568,385 @@ def clustConnectLink(linkageCheck):
     logging.info(': Success! Metabolite clusters determined.')
     return validationClusters
 
-def clustConnect(dataMST,mstOutNp):
+def linkageRoots(parent):
+    '''
+    Resolve every entry of a union-find parent array to the root of its tree using vectorized pointer jumping.
+
+    Input:
+    parent - integer numpy array where parent[i] is the node i was merged into (roots point to themselves)
+
+    Output:
+    numpy array of the same size containing the root of each node.
+    '''
+    roots = parent.copy()
+    while True:
+        #jump every node to its grandparent until no node moves
+        jumped = roots[roots]
+        if np.array_equal(jumped, roots):
+            return roots
+        roots = jumped
+
+def linkageLabels(linkageCheck,numClusters):
     '''
-    Clustering connections determination from the minimum spanning tree output. 
+    Determine the partition of the metabolites into numClusters clusters directly from a scipy linkage output. This replaces walking every
+    level of clustConnectLink when only a single level of the hierarchy is needed.
 
     Input:
-    dataMST - direct output from the MST
-    mstOutNp - numpy array of the output. 
+
+    linkageCheck - a scipy linkage output
+    numClusters - number of clusters in the wanted partition (1 to N)
 
     Output:
-    dictionary of all possible clusterings combinations for the data. 
 
+    int32 numpy array of length N with the cluster label (0 to numClusters-1) of each metabolite.
     '''
-    logging.info(': Determining the metabolite cluster for MST.')
-    #Create an empty dictionary that will contain the clusters
-    clusters = {}
+    numMetabs = linkageCheck.shape[0]+1
+    numClusters = int(numClusters)
+    if numClusters < 1 or numClusters > numMetabs:
+        logging.error(': Number of clusters requested is outside the range of the linkage.')
+        raise ValueError('numClusters must be between 1 and ' + str(numMetabs))
 
-    #create an empty dictionary that allows us to save the clusters for validation.
-    validationClusters = {}
+    #number of merges needed to reach the requested number of clusters
+    numMerges = numMetabs-numClusters
+    connections = linkageCheck[:numMerges,:2].astype(np.int64)
 
-    # create initial list of metabolites that serves as the initial list of metabolites that will be clustered.
-    metabolites = np.ones((dataMST.shape[0]+1,1))
+    #every node points at itself until it is merged into the node created by the linkage step
+    parent = np.arange(2*numMetabs-1)
+    newNodes = np.arange(numMetabs,numMetabs+numMerges)
+    parent[connections[:,0]] = newNodes
+    parent[connections[:,1]] = newNodes
 
-    for i in range(dataMST.shape[0]):
-        #pull out the connections for the current iteration
-        curCon1 = mstOutNp[i,0]
-        curCon2 = mstOutNp[i,1]
+    roots = linkageRoots(parent)[:numMetabs]
+    labels = np.unique(roots,return_inverse=True)[1]
+    return labels.astype(np.int32)
 
-        curCon1 = int(curCon1)
-        curCon2 = int(curCon2)
+def linkageLabelsRange(linkageCheck,clusterRange):
+    '''
+    Determine the partitions for several numbers of clusters from a single pass over the scipy linkage output.
 
-        if i == 0:
-            #convert the metabolites to string for easier comparison
-            firstConnect = [curCon1, curCon2]
+    Input:
 
-            #set the metabolites equal to zero in the initial metabolite list
-            metabolites[curCon1,0] = 0 
-            metabolites[curCon2,0] = 0
+    linkageCheck - a scipy linkage output
+    clusterRange - iterable of the numbers of clusters wanted (e.g., range(2,101))
 
-            #create dictionary of clusters 
-            for j in range(dataMST.shape[0]-(i+1)):
-                clusters.update({j:j})
-            
-            #find the metabolites that are ones and were not clustered
-            unClustered = np.where(metabolites == 1)
+    Output:
 
-            #input the connection
-            clusters[0] = firstConnect
-            
-            for j in range(1,dataMST.shape[0]):
-                #input the cluster values into the dictionary
-                clusters[j] = unClustered[0][j-1]
+    dictionary with the number of clusters as keys and int32 label arrays (see linkageLabels) as values.
+    '''
+    numMetabs = linkageCheck.shape[0]+1
+    clusterRange = sorted(set(int(k) for k in clusterRange),reverse=True)
+    if len(clusterRange) == 0:
+        return {}
+    if clusterRange[-1] < 1 or clusterRange[0] > numMetabs:
+        logging.error(': Number of clusters requested is outside the range of the linkage.')
+        raise ValueError('numbers of clusters must be between 1 and ' + str(numMetabs))
+
+    connections = linkageCheck[:,:2].astype(np.int64)
+    parent = np.arange(2*numMetabs-1)
+    partitions = {}
+    merged = 0
+    for numClusters in clusterRange:
+        #apply the merges between the previous level and the current level
+        numMerges = numMetabs-numClusters
+        newNodes = np.arange(numMetabs+merged,numMetabs+numMerges)
+        parent[connections[merged:numMerges,0]] = newNodes
+        parent[connections[merged:numMerges,1]] = newNodes
+        merged = numMerges
+
+        #compress the paths so later levels start from shallow trees
+        parent = linkageRoots(parent)
+        labels = np.unique(parent[:numMetabs],return_inverse=True)[1]
+        partitions[numClusters] = labels.astype(np.int32)
+
+    return partitions
+
+def labelsToClusters(labels):
+    '''
+    Convert a label array into the dictionary of clusters used by clustConnectLink and the validation metrics.
+
+    Input:
+    labels - integer numpy array with the cluster label of each metabolite
+
+    Output:
+    dictionary with a key for each cluster, containing a list of metabolites for clusters of more than one metabolite and an integer for single metabolites.
+    '''
+    labels = np.asarray(labels)
+    order = np.argsort(labels,kind='stable')
+    bounds = np.flatnonzero(np.diff(labels[order]))+1
+    clusters = {}
+    for i, members in enumerate(np.split(order,bounds)):
+        if len(members) > 1:
+            clusters[i] = [int(m) for m in members]
         else:
-            #save the previous dictionary 
-            clusterPrevious = clusters
-            del(clusters)
-            clusters = {}
+            clusters[i] = int(members[0])
+    return clusters
 
-            #create a new dictionary 
-            for j in range(dataMST.shape[0]-(i+1)):
-                clusters.update({j:j})
+def validationLevels(numMetabs):
+    '''
+    Numbers of clusters checked by MST cluster validation, the last 101 levels of the hierarchy (or the last half for under 100 levels).
 
-            #grab the latest connections
-            curCon1 = mstOutNp[i,0]
-            curCon2 = mstOutNp[i,1]
+    Input:
+    numMetabs - number of metabolites
 
-            curCon1 = int(curCon1)
-            curCon2 = int(curCon2)
+    Output:
+    list of the numbers of clusters from the most to the fewest clusters.
+    '''
+    numLevels = numMetabs-1
+    if numLevels < 100:
+        maxClusters = int(numLevels/2)
+    else:
+        maxClusters = min(101,numLevels)
+    return list(range(maxClusters,0,-1))
 
-            curCon1Connect = 0;
-            curCon2Connect = 0;
-            unchanged = []
+def validationInit(data,edges,metric,args):
+    '''
+    Pool initializer for the MST validation workers, the data and tree edges are sent to each worker once rather than with every level.
 
-            previousKey = list(clusterPrevious.keys())
-            previousKey = len(previousKey)
+    Input:
+    data - pre-processed data
+    edges - sorted minimum spanning tree edges
+    metric - validation function (Validate or a ValidationMetric function)
+    args - arguments of the validation function following the data (e.g., (num_groups,) or (num_groups, Eo))
+    '''
+    global validationData, validationEdges, validationMetric, validationArgs
+    validationData = data
+    validationEdges = edges
+    validationMetric = metric
+    validationArgs = args
 
-            for k in range(previousKey):
-                #Determine if any of the new clustered meatbolites 
-                curCheck = clusterPrevious[k]
+def validationLevel(numClusters,labels=None):
+    '''
+    Validate a single level of the MST hierarchy with the metric given to validationInit, rebuilding the level from the tree edges.
 
-                if isinstance(curCheck, list):
-                    #check list for the first connection
-                    curCon1Check = curCon1 in curCheck
+    Input:
+    numClusters - number of clusters of the level
 
-                    #check list for the second connection
-                    curCon2Check = curCon2 in curCheck
+    Optional:
+    labels - label array of the level, rebuilt from the edges when not given
 
-                    if curCon1Check == True and curCon2Check == False:
-                        curCon1Connect = 1
-                        curCon1Location = k
-                    elif curCon1Check == False and curCon2Check == True:
-                        curCon2Connect = 1
-                        curCon2Location = k
-                    elif curCon1Check == False and curCon2Check == False:
-                        unchanged.append(k)
-                    elif curCon1Check == True and curCon2Check == True:
-                        logging.warning(': Issue clustering the data a duplication has been discovered.')
+    Output:
+    output of the validation function for the level
+    '''
+    if labels is None:
+        labels = mstLabels(validationEdges,numClusters)
+    return validationMetric({0:labelsToClusters(labels)},validationData,*validationArgs)
 
+def validationScores(metric,data,edges,args,numThreads=1):
+    '''
+    Validate the levels of the MST hierarchy given by validationLevels. A single process streams the levels from mstPartitions, a pool
+    of numThreads processes rebuilds each level from the tree edges, so only the label arrays of the levels in progress are kept.
 
-                elif isinstance(curCheck, np.integer) or isinstance(curCheck, int):
-                    #check list for the first connection
-                    curCon1Check = curCon1 == curCheck
+    Input:
+    metric - validation function (Validate or a ValidationMetric function)
+    data - pre-processed data
+    edges - sorted minimum spanning tree edges
+    args - arguments of the validation function following the data (e.g., (num_groups,) or (num_groups, Eo))
 
-                    #check list for the second connection
-                    curCon2Check = curCon2 == curCheck
+    Optional:
+    numThreads - number of processes to use (config.numThreads)
 
-                    if curCon1Check == True and curCon2Check == False:
-                        curCon1Connect = 1
-                        curCon1Location = k
-                    elif curCon1Check == False and curCon2Check == True:
-                        curCon2Connect = 1
-                        curCon2Location = k
-                    elif curCon1Check == False and curCon2Check == False:
-                        unchanged.append(k)
-                    elif curCon1Check == True and curCon2Check == True:
-                        logging.warning(': Issue clustering the data a duplication has been discovered.')
+    Output:
+    numpy array of the validation function outputs from the most to the fewest clusters.
+    '''
+    levels = validationLevels(data.shape[0])
+    if int(numThreads) <= 1:
+        validationInit(data,edges,metric,args)
+        valIndex = [validationLevel(numClusters,labels) for numClusters, labels in mstPartitions(edges,levels)]
+    else:
+        with Pool(min(int(numThreads),len(levels)),initializer=validationInit,initargs=(data,edges,metric,args)) as p:
+            valIndex = p.map(validationLevel,levels)
+    return np.asarray(valIndex)
+
+def validationSweep(data,edges,levels=None):
+    '''
+    K-means based (Validate), Davies-Bouldin and PBM validation of the levels of the MST hierarchy in a single pass over the merges.
+    The cluster sizes, sums and centers are found once for the level with the most clusters, after that each merge only updates the
+    merged cluster (its center from the merge formula, its distances to the members and to the other centers).
+
+    Input:
+    data - pre-processed data
+    edges - sorted minimum spanning tree edges
+
+    Optional:
+    levels - numbers of clusters to validate, validationLevels when not given
+
+    Output:
+    dictionary of 'KMeansBased', 'DBI' and 'PBM' to numpy arrays of the validation outputs from the most to the fewest clusters (in the
+    same format as the validationScores outputs of Validate, ValidationMetric.daviesBouldin and ValidationMetric.PBM).
+    '''
+    numMetabs = data.shape[0]
+    if levels is None:
+        levels = validationLevels(numMetabs)
+    levels = sorted(set(int(k) for k in levels),reverse=True)
+    scores = {'KMeansBased':[],'DBI':[],'PBM':[]}
+    if len(levels) == 0:
+        return {valMet:np.asarray(scores[valMet]) for valMet in scores}
+
+    #sum of the distances of the data to the center of all the data
+    Eo = np.sum(np.linalg.norm(data-np.mean(data,axis=0),axis=1))
+
+    #cluster statistics of the first level
+    numClusters = levels[0]
+    labels = mstLabels(edges,numClusters)
+    centers = groupReduce(data,labels,stats=('mean',))[1]['mean']
+    order = np.argsort(labels,kind='stable')
+    members = np.split(order,np.flatnonzero(np.diff(labels[order]))+1)
+    sizes = np.array([len(cluster) for cluster in members],dtype=float)
+    sumIntra = np.bincount(labels,weights=np.linalg.norm(data-centers[labels],axis=1),minlength=numClusters)
+    centerDists = squareform(pdist(centers))
+    active = np.ones(numClusters,dtype=bool)
+
+    merge = numMetabs-numClusters
+    for numClusters in levels:
+        while merge < numMetabs-numClusters:
+            #merge the clusters joined by the next edge into the cluster of the first metabolite
+            cluster1, cluster2 = labels[int(edges[merge,0])], labels[int(edges[merge,1])]
+            merged = np.concatenate((members[cluster1],members[cluster2]))
+            labels[members[cluster2]] = cluster1
+            centers[cluster1] = (sizes[cluster1]*centers[cluster1]+sizes[cluster2]*centers[cluster2])/(sizes[cluster1]+sizes[cluster2])
+            sizes[cluster1] += sizes[cluster2]
+            members[cluster1], members[cluster2] = merged, None
+            sumIntra[cluster1] = np.sum(np.linalg.norm(data[merged]-centers[cluster1],axis=1))
+            active[cluster2] = False
+            centerDists[cluster1,:] = np.linalg.norm(centers-centers[cluster1],axis=1)
+            centerDists[:,cluster1] = centerDists[cluster1,:]
+            merge += 1
+
+        curClusters = np.flatnonzero(active)
+        curDists = centerDists[np.ix_(curClusters,curClusters)]
+        curIntra = sumIntra[curClusters]
+        if numClusters > 1:
+            #k-means based, average compactness over the minimum non-zero separation of the centers
+            separations = curDists[np.triu_indices(numClusters,1)]
+            interDist = min(1000,np.min(separations[separations != 0],initial=1000))
+            kMeansBased = (np.sum(curIntra)/numMetabs)/interDist
+
+            #Davies-Bouldin, average over the clusters of the maximum (dispersion_i + dispersion_j)/separation_ij
+            dispersion = curIntra/sizes[curClusters]
+            with np.errstate(divide='ignore',invalid='ignore'):
+                R = (dispersion[:,None]+dispersion[None,:])/curDists
+            R[~(R > 0)] = 0
+            np.fill_diagonal(R,0)
+            dbi = np.sum(np.max(R,axis=1))/numClusters
+
+            #PBM, ((maximum separation/K)*(Eo/total compactness))^2
+            with np.errstate(divide='ignore'):
+                pbm = ((np.max(separations)/numClusters)*(Eo/np.sum(curIntra)))**2
+        else:
+            kMeansBased, dbi, pbm = 1, 10, 0
 
+        scores['KMeansBased'].append([[kMeansBased],[numClusters]])
+        scores['DBI'].append([[dbi,numClusters]])
+        scores['PBM'].append([[pbm,numClusters]])
 
-                else:
-                    logCheck = type(curCheck)
-                    logging.error(logCheck)
-                    logging.error(': Inappropriate data type for the for clustering ID algorithm.')
-                    return
+    return {valMet:np.asarray(scores[valMet],dtype=float) for valMet in scores}
 
-                if curCon1Connect == 1 and curCon2Connect == 1 and k == previousKey-1:
-                    for m in range(1,len(unchanged)+1):
-                        #cluster the appropriate remaining clusters together
-                        clusters[m] = clusterPrevious[unchanged[m-1]]
+def silhouetteSweep(data,edges,levels=None,blockSize=2048,sampleSize=None,confidence=0.95,seed=None):
+    '''
+    Silhouette validation of the levels of the MST hierarchy. The distances are computed once, blockSize rows at a time, and reduced to
+    the sum of the distances from each metabolite to each cluster of the level with the most clusters. A merge adds the sums of the two
+    clusters, so each later level costs O(N*K) instead of recomputing the distances. The index of a level is the average over the
+    clusters of the mean silhouette of their metabolites, b(x) is the smallest mean distance to another cluster and singletons score 0.
 
-                    newConnect1 = clusterPrevious[curCon1Location]
-                    newConnect2 = clusterPrevious[curCon2Location]
-                    
-                    if isinstance(newConnect1,list) and isinstance(newConnect2, list):
-                        newConnect = newConnect1 + newConnect2
-                        clusters[0] = newConnect
-                    elif isinstance(newConnect1,list) and isinstance(newConnect2, np.integer):
-                        newConnect = newConnect1
-                        intList = newConnect[:] + [newConnect2]
-                        clusters[0] = intList
-                    elif isinstance(newConnect1,np.integer) and isinstance(newConnect2, list):
-                        newConnect = newConnect2
-                        intList = newConnect[:] + [newConnect1]
-                        clusters[0] = intList
-                    elif isinstance(newConnect1,np.integer) and isinstance(newConnect2,np.integer):
-                        newConnect = [newConnect1, newConnect2]
-                        clusters[0] =newConnect
+    Input:
+    data - pre-processed data
+    edges - sorted minimum spanning tree edges
+
+    Optional:
+    levels - numbers of clusters to validate, validationLevels when not given
+    blockSize - number of rows of distances computed at a time
+    sampleSize - number of metabolites sampled from each cluster of the level with the most clusters to estimate the index, smaller 
+    clusters are used whole (None uses every metabolite, exact)
+    confidence - probability each sampled estimate is within its error bound
+    seed - seed of the random sample, so an estimate can be reproduced
+
+    Output:
+    valIndex - numpy array of the silhouette index and number of clusters from the most to the fewest clusters (in the same format as the
+    validationScores output of ValidationMetric.Silhouette)
+    errors - numpy array of the error bound of each index (Hoeffding bound over the sampled clusters, 0 when every metabolite is used)
+    clusterErrors - list of numpy arrays (one per level) of the error bound of each cluster's mean silhouette
+    '''
+    numMetabs = data.shape[0]
+    if levels is None:
+        levels = validationLevels(numMetabs)
+    levels = sorted(set(int(k) for k in levels),reverse=True)
+    valIndex = []
+    errors = []
+    clusterErrors = []
+    if len(levels) == 0:
+        return np.asarray(valIndex), np.asarray(errors), clusterErrors
+
+    numClusters = levels[0]
+    labels = mstLabels(edges,numClusters)
+    order = np.argsort(labels,kind='stable')
+    members = np.split(order,np.flatnonzero(np.diff(labels[order]))+1)
+    sizes = np.array([len(cluster) for cluster in members],dtype=float)
+
+    #metabolites the silhouettes are computed for, sampled within each cluster of the first level (merged clusters keep their samples)
+    if sampleSize is None:
+        rows = np.arange(numMetabs)
+    else:
+        rng = np.random.default_rng(seed)
+        sampleSize = max(int(sampleSize),1)
+        rows = np.sort(np.concatenate([cluster if len(cluster) <= sampleSize else rng.choice(cluster,size=sampleSize,replace=False)
+                                       for cluster in members]))
+    numRows = rows.shape[0]
+    #number of metabolites of its first level cluster each sampled metabolite stands in for, only sampled clusters add to the error
+    strata = labels[rows]
+    numSampled = np.bincount(strata,minlength=numClusters)
+    rowWeights = sizes[strata]/numSampled[strata]
+    sampled = numSampled[strata] < sizes[strata]
+    errorScale = np.sqrt(2*np.log(2/(1-confidence)))
+
+    #sum of the distances from each metabolite to each cluster of the first level
+    clusterMatrix = np.zeros((numMetabs,numClusters))
+    clusterMatrix[np.arange(numMetabs),labels] = 1
+    distSums = np.zeros((numRows,numClusters))
+    for start in range(0,numRows,blockSize):
+        distSums[start:start+blockSize,:] = cdist(data[rows[start:start+blockSize]],data) @ clusterMatrix
+    del(clusterMatrix)
+
+    active = np.ones(numClusters,dtype=bool)
+
+    merge = numMetabs-numClusters
+    for numClusters in levels:
+        while merge < numMetabs-numClusters:
+            #merge the clusters joined by the next edge into the cluster of the first metabolite
+            cluster1, cluster2 = labels[int(edges[merge,0])], labels[int(edges[merge,1])]
+            labels[members[cluster2]] = cluster1
+            members[cluster1], members[cluster2] = np.concatenate((members[cluster1],members[cluster2])), None
+            sizes[cluster1] += sizes[cluster2]
+            distSums[:,cluster1] += distSums[:,cluster2]
+            active[cluster2] = False
+            merge += 1
+
+        if numClusters < 2:
+            valIndex.append([[0,numClusters]])
+            errors.append(0)
+            clusterErrors.append(np.zeros(numClusters))
+            continue
+
+        #average distance to the metabolite's own cluster (a) and the closest other cluster (b)
+        curClusters = np.flatnonzero(active)
+        own = labels[rows]
+        ownSizes = sizes[own]
+        a = distSums[np.arange(numRows),own]/np.maximum(ownSizes-1,1)
+        means = distSums[:,curClusters]/sizes[curClusters]
+        means[curClusters[None,:] == own[:,None]] = np.inf
+        b = np.min(means,axis=1)
+        denominator = np.maximum(a,b)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            silhouettes = np.where((denominator > 0) & (ownSizes > 1),(b-a)/denominator,0)
+
+        #average of the cluster averages, the silhouettes lie in [-1,1] so the Hoeffding bound of a weighted sum is sqrt(2*ln(2/alpha)*sum(weights^2))
+        weights = rowWeights/ownSizes
+        valIndex.append([[np.sum(silhouettes*weights)/numClusters,numClusters]])
+        errors.append(min(2,errorScale*np.sqrt(np.sum((weights[sampled]/numClusters)**2))))
+        clusterVar = np.bincount(own[sampled],weights=weights[sampled]**2,minlength=len(active))[curClusters]
+        clusterErrors.append(np.minimum(2,errorScale*np.sqrt(clusterVar)))
+
+    return np.asarray(valIndex,dtype=float), np.asarray(errors,dtype=float), clusterErrors
 
-        validationClusters.update({i:clusters})
-    logging.info(': Success! MST clusters determined.')
-    return validationClusters
-    
 def Validate(data,dists,num_groups):
     '''
     Determine the appropriate number of clusters for the optimal clustering of a input data set. 
@@ -976,7 +2063,7 @@ def Validate(data,dists,num_groups):
 
     return val_index
 
-def recClusters(dataFinal,heatmapAxes,groupDendLeaves,metab_data,minMetabs,numClusts):
+def recClusters(dataFinal,heatmapAxes,groupDendLeaves,metab_data,minMetabs,numClusts,run=None,dataset=None):
     '''
     Determines the areas containing 100% clusters metabolites for the 13 separate clusterings performed. 
 
@@ -986,13 +2073,20 @@ def recClusters(dataFinal,heatmapAxes,groupDendLeaves,metab_data,minMetabs,numCl
     groupDendLeaves - leaves of current dendrogram being studied.
     metab_data - raw data.
 
+    Optional:
+    run - OutputRun the cluster files belong to
+    dataset - Dataset of metab_data (duplicates collapsed by the dataset are added to the cluster files)
+
     Output:
-    sends data to the ensembleClustersOut function to export ensemble clusters. 
+    sends the clusters to the exportClusters function to export ensemble clusters. 
     '''
 
     #determine the appropriate number ensemble clusters and there location
     ensemMetabs = dataFinal.shape[0]
 
+    #clusters gathered for a single export once all of the clusters are found
+    clusters = []
+
     #set the current row to check in the ensembles output
     j = 0
     while j < ensemMetabs:
@@ -1003,7 +2097,7 @@ def recClusters(dataFinal,heatmapAxes,groupDendLeaves,metab_data,minMetabs,numCl
         #determine the length of the array found
         if len(found[0])==1:
             maxMetab = found[0]
-            ensembleClustersOut(found[0],groupDendLeaves,metab_data,minMetabs)
+            clusters.append(found[0])
             #then simply take the current j value and give it limits of j-0.5 to j+0.5, in the x and y directions.
             arrays = {0:np.linspace(j, maxMetab+1, num=5),1:np.linspace(j, j, num=5),2:np.linspace(maxMetab+1, maxMetab+1, num=5)}
 
@@ -1019,7 +2113,7 @@ def recClusters(dataFinal,heatmapAxes,groupDendLeaves,metab_data,minMetabs,numCl
         else:
             #use j and the maximum value from the connection search to locate create the outline
             maxMetab = max(found[0])
-            ensembleClustersOut(found[0],groupDendLeaves,metab_data,minMetabs)
+            clusters.append(found[0])
             arrays = {0:np.linspace(j, maxMetab+1, num=5),1:np.linspace(j, j, num=5),2:np.linspace(maxMetab+1, maxMetab+1, num=5)}
 
             if len(found[0]) >= minMetabs:
@@ -1033,10 +2127,14 @@ def recClusters(dataFinal,heatmapAxes,groupDendLeaves,metab_data,minMetabs,numCl
                 heatmapAxes.text(midPoint,midPoint,numMetabs,color='red',fontsize=7)
             j = maxMetab + 1
             del(arrays)
+
+    #export every cluster with at least the minimum number of metabolites
+    clusters = [cluster for cluster in clusters if len(cluster) >= minMetabs]
+    exportClusters(clusters,groupDendLeaves,metab_data,run=run,dataset=dataset)
     messagebox.showinfo(title="Success",message="Successfully created ensemble clustergram and cluster files!!")
     return
 
-def ensembleClustersOut(found,groupDendLeaves,metab_data,minMetabs):
+def ensembleClustersOut(found,groupDendLeaves,metab_data,minMetabs,run=None):
     '''
     Intake the connected clusters of all ones and output a file with the appropriate title. This function should not be called on
     it's own but should be called through the recClusters function (which automatically recommends clusters for the user).
@@ -1047,106 +2145,567 @@ def ensembleClustersOut(found,groupDendLeaves,metab_data,minMetabs):
     groupDendLeaves - leaves of the current clustering of interest. 
     metab_data - raw data
 
+    Optional:
+    run - OutputRun the file belongs to
+
     Output:
-    csv files of the found metabolite clusters. 
+    excel file of the found metabolite cluster (see exportClusters for exporting many clusters at once). 
     '''
+    if len(found) >= minMetabs:
+        exportClusters([found],groupDendLeaves,metab_data,mode='legacy',run=run)
 
-    logging.info(': Creating ensemble clusters output files.')
-    #take the found metabolites/biomarkers/etc. and grab the indicies which are matching in the Leaves of the dendrogram. 
-    lenFound = len(found)
-    foundMetabs = np.zeros((lenFound,metab_data.shape[1]-1))
-    columnHeaders = foundMetabs.shape[1]
+def renderInit():
+    '''
+    Initialize a figure rendering process (no GUI backend is needed to save figures).
+    '''
+    plt.switch_backend('Agg')
 
-    #check the data type for the first column of the DataFrame
-    columnsData = list(metab_data.columns)
+def renderFigure(figBytes,file,kwargs):
+    '''
+    Render a pickled matplotlib figure to a file, run in the rendering process of the ArtifactWriter.
+
+    Input:
+    figBytes - pickled figure
+    file - output file name
+    kwargs - keyword arguments for savefig
+
+    Output:
+    file name of the saved figure
+    '''
+    fig = pickle.loads(figBytes)
+    fig.savefig(file,**kwargs)
+    plt.close(fig)
+    return file
+
+class ArtifactWriter:
+    '''
+    Write figures and tables in the background so that the next stage of an analysis can run while the outputs are serialized.
+    Jobs go through a bounded queue to a set of writer threads, figures are pickled and rendered in a separate process. 
+    Errors are collected and raised by flush.
 
-    #create a dictionary of values for the indexing of the output of the ensemble fits.
-    textList = metab_data[columnsData[0]]
-    textList = textList.to_dict()
+    Input:
+    numWriters - number of writer threads
 
-    #Get the raw data columns from the DataFrame
-    columnsData = columnsData[1:len(columnsData)]#-1]
-    rawData = metab_data[columnsData]
+    Optional:
+    maxPending - number of jobs that can be waiting before submitting blocks
+    background - False writes every artifact immediately on the calling thread
+    renderProcess - render figures in a separate process, otherwise figures are saved on the calling thread
+    '''
 
-    rawData = rawData.to_numpy()
+    def __init__(self,numWriters=2,maxPending=8,background=True,renderProcess=True):
+        self.background = background
+        self.renderProcess = renderProcess
+        self.jobs = queue.Queue(maxsize=max(int(maxPending),1))
+        self.lock = threading.Lock()
+        self.errors = []
+        self.renderPool = None
+        self.threads = []
+        if self.background:
+            for i in range(max(int(numWriters),1)):
+                thread = threading.Thread(target=self.work,name='ArtifactWriter'+str(i),daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            atexit.register(self.close)
+
+    def work(self):
+        '''
+        Writer thread loop, runs jobs until a None job is received.
+        '''
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            file, func, args, kwargs = job
+            try:
+                func(*args,**kwargs)
+                logging.info(': Saved ' + str(file))
+            except Exception as err:
+                logging.error(': Failed to save ' + str(file) + ', ' + repr(err))
+                with self.lock:
+                    self.errors.append((file,err))
+            finally:
+                self.jobs.task_done()
+
+    def submit(self,file,func,*args,**kwargs):
+        '''
+        Queue func(*args,**kwargs) which writes file, blocks while the queue is full.
+
+        Input:
+        file - name of the file being written
+        func - function that writes the file
+        '''
+        if not self.background:
+            func(*args,**kwargs)
+            return
+        self.jobs.put((file,func,args,kwargs))
+
+    def saveTable(self,frame,file,**kwargs):
+        '''
+        Save a data frame as a csv, excel or parquet file (chosen by the file extension). The frame should not be changed after it is submitted.
+
+        Input:
+        frame - pandas data frame
+        file - output file name
+        kwargs - keyword arguments for the pandas writer (e.g. index=False)
+        '''
+        ext = os.path.splitext(file)[1].lower()
+        if ext in ('.csv','.txt'):
+            func = frame.to_csv
+        elif ext == '.parquet':
+            func = frame.to_parquet
+        else:
+            func = frame.to_excel
+        self.submit(file,func,file,**kwargs)
+
+    def saveWorkbook(self,sheets,file,**kwargs):
+        '''
+        Save several data frames as the sheets of one excel workbook.
+
+        Input:
+        sheets - dictionary of sheet names and data frames
+        file - output file name
+        kwargs - keyword arguments for to_excel (e.g. index=False)
+        '''
+        def writeWorkbook():
+            with pd.ExcelWriter(file) as writer:
+                for sheet, frame in sheets.items():
+                    frame.to_excel(writer,sheet_name=sheet,**kwargs)
+        self.submit(file,writeWorkbook)
+
+    def saveFigure(self,fig,file,**kwargs):
+        '''
+        Save a matplotlib figure. The figure is pickled when submitted, so it can be shown or closed right away.
+
+        Input:
+        fig - matplotlib figure
+        file - output file name
+        kwargs - keyword arguments for savefig (e.g. dpi=600)
+        '''
+        if not self.background or not self.renderProcess:
+            fig.savefig(file,**kwargs)
+            return
+        try:
+            figBytes = pickle.dumps(fig)
+        except Exception:
+            #some artists can not be pickled, save these figures on the calling thread
+            logging.warning(': Unable to render ' + str(file) + ' in the background, saving now.')
+            fig.savefig(file,**kwargs)
+            return
+        with self.lock:
+            if self.renderPool is None:
+                self.renderPool = ProcessPoolExecutor(max_workers=1,initializer=renderInit)
+            renderPool = self.renderPool
+        self.submit(file,lambda: renderPool.submit(renderFigure,figBytes,file,kwargs).result())
+
+    def flush(self):
+        '''
+        Wait for all queued artifacts to be written and raise the first error that occured since the last flush.
+        '''
+        if self.background:
+            self.jobs.join()
+        with self.lock:
+            errors = self.errors
+            self.errors = []
+        if len(errors) > 0:
+            file, err = errors[0]
+            raise OSError('Failed to write ' + str(len(errors)) + ' output file(s), first failure: ' + str(file)) from err
+
+    def close(self):
+        '''
+        Write the remaining artifacts and stop the writer threads and the rendering process.
+        '''
+        if len(self.threads) > 0:
+            self.jobs.join()
+            for i in range(len(self.threads)):
+                self.jobs.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+        if self.renderPool is not None:
+            self.renderPool.shutdown()
+            self.renderPool = None
+
+outputWriter = None
+
+def getOutputWriter():
+    '''
+    Output:
+    the ArtifactWriter shared by the analyses (created on first use from the config settings).
+    '''
+    global outputWriter
+    if outputWriter is None:
+        outputWriter = ArtifactWriter(numWriters=config.outputWriters,maxPending=config.outputQueueSize,background=config.backgroundOutput)
+    return outputWriter
 
-    #set prefix that will be used for all files
-    ensemPre = 'EnsembleCluster'
-    ensemSuf = '.xlsx'
+def flushOutputs():
+    '''
+    Wait for the background writer to finish, errors are logged and shown to the user.
 
+    Output:
+    True if every output was written.
+    '''
+    if outputWriter is None:
+        return True
     try:
-        del(idents)
-    except:
-        logging.warning(': Deleting variable prior to its creation is not advised!!')
+        outputWriter.flush()
+    except OSError as err:
+        logging.error(': ' + str(err))
+        messagebox.showerror(title='Error',message=str(err))
+        return False
+    return True
+
+class OutputRun:
+    '''
+    Output directory of a single analysis run. Every writer takes the run and asks it for file paths, so the current working
+    directory is never changed and several analyses can write at the same time from one process. Numbered file names are 
+    handed out from a counter per directory and name pattern (shared by all runs, so runs writing to the same directory do not
+    collide) and every path given out is recorded in the run's manifest.
+
+    Optional:
+    outDir - directory the outputs are saved in (created if needed), defaults to the current working directory.
+    '''
+    counterLock = threading.Lock()
+    counters = {}
+
+    def __init__(self,outDir=None):
+        if outDir is None:
+            outDir = os.getcwd()
+        self.outDir = os.path.abspath(outDir)
+        os.makedirs(self.outDir,exist_ok=True)
+        self.lock = threading.Lock()
+        self.manifest = []
+
+    def path(self,name,subDir=''):
+        '''
+        Input:
+        name - file name
+
+        Optional:
+        subDir - sub-directory of the run directory (created if needed)
+
+        Output:
+        full path of the file, which is added to the manifest.
+        '''
+        directory = os.path.join(self.outDir,subDir)
+        os.makedirs(directory,exist_ok=True)
+        file = os.path.join(directory,name)
+        with self.lock:
+            if file not in self.manifest:
+                self.manifest.append(file)
+        return file
+
+    def nextNames(self,prefix,suffix,count=1,subDir=''):
+        '''
+        Allocate the next numbered file names (prefix01suffix, prefix02suffix, ...).
+
+        Input:
+        prefix - beginning of the file names
+        suffix - file extension
+
+        Optional:
+        count - number of file names needed
+        subDir - sub-directory of the run directory (created if needed)
+
+        Output:
+        list of full paths, which are added to the manifest.
+        '''
+        directory = os.path.join(self.outDir,subDir)
+        os.makedirs(directory,exist_ok=True)
+        key = (os.path.normcase(os.path.abspath(directory)),prefix,suffix)
+        with OutputRun.counterLock:
+            if key not in OutputRun.counters:
+                #start after any numbered files left in the directory by earlier runs
+                OutputRun.counters[key] = self.lastNumber(directory,prefix,suffix)
+            first = OutputRun.counters[key] + 1
+            OutputRun.counters[key] += count
+        files = [os.path.join(directory,prefix + str(num).zfill(2) + suffix) for num in range(first,first+count)]
+        with self.lock:
+            self.manifest.extend(files)
+        return files
+
+    @staticmethod
+    def lastNumber(directory,prefix,suffix):
+        '''
+        Output:
+        largest number used by prefixNNsuffix files in the directory (0 if there are none).
+        '''
+        pattern = re.compile(re.escape(prefix) + r'(\d+)' + re.escape(suffix) + '$')
+        last = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                match = pattern.match(entry.name)
+                if match:
+                    last = max(last,int(match.group(1)))
+        return last
+
+    def files(self):
+        '''
+        Output:
+        list of the paths handed out by the run.
+        '''
+        with self.lock:
+            return list(self.manifest)
+
+outputRun = None
+
+def getOutputRun(run=None):
+    '''
+    Optional:
+    run - OutputRun, returned as is when given
 
+    Output:
+    the given run, otherwise the default run (created on first use in config.outputDir or the current working directory).
+    '''
+    global outputRun
+    if run is not None:
+        return run
+    if outputRun is None:
+        outputRun = OutputRun(config.outputDir)
+    return outputRun
+
+def exportClusters(clusters,groupDendLeaves,metab_data,mode=None,outDir='EnsembleOutputFiles',run=None,dataset=None):
+    '''
+    Export all of the ensemble clusters in a single pass.
 
-    #check for an EnsembleOutputFiles directory in the current directory
-    if os.path.isdir('EnsembleOutputFiles'):
-        os.chdir('EnsembleOutputFiles')
-    else:
-        os.mkdir('EnsembleOutputFiles')
-        os.chdir('EnsembleOutputFiles')
+    Input:
+    clusters - list of arrays of the positions (in the ensemble heatmap) of the metabolites in each cluster
+    groupDendLeaves - leaves of the current clustering of interest. 
+    metab_data - raw data
+
+    Optional:
+    mode - 'workbook' (one excel workbook with a sheet per cluster), 'csv' or 'parquet' (one long format file with a Cluster column),
+    or 'legacy' (an excel workbook per cluster), defaults to config.clusterExport
+    outDir - sub-directory of the run directory the files are saved in
+    run - OutputRun the files belong to (see getOutputRun)
+    dataset - Dataset of metab_data, the clusters are expanded to every duplicate metabolite collapsed by the dataset
 
-    if lenFound >= minMetabs:
-        idents = []
-        for i in range(lenFound):
-            #match the 
-            foundMetabs[i,:] = rawData[groupDendLeaves[found[i]],:]
+    Output:
+    files of the found metabolite clusters (written in the background, see flushOutputs), returns the paths of the files. 
+    '''
+    logging.info(': Creating ensemble clusters output files.')
+    if mode is None:
+        mode = config.clusterExport
+    if len(clusters) == 0:
+        return []
+    run = getOutputRun(run)
 
-            #save a list that contains identities for the study
-            idents.append(textList[groupDendLeaves[found[i]]])
+    expand = dataset is not None and len(dataset.duplicates) > 0
+    if expand:
+        metab_data = dataset.fullRaw
 
-        #create column headers for the data frame
-        columns = []
-        for i in range(columnHeaders-1):
-            columns.append("M"+str(i+1))
-        columns.append("rt_med")
+    #convert the raw data a single time for all of the clusters
+    columnsData = list(metab_data.columns)
+    idents = metab_data[columnsData[0]].to_numpy()
+    rawData = metab_data[columnsData[1:]].to_numpy(dtype=float)
+    leaves = np.asarray(groupDendLeaves)
 
-        foundMetabs = pd.DataFrame(foundMetabs,columns=columns)
+    #create column headers for the data frame
+    columns = []
+    for i in range(rawData.shape[1]-1):
+        columns.append("M"+str(i+1))
+    columns.append("rt_med")
 
+    clusterFrames = []
+    for cluster in clusters:
+        #match the heatmap positions to the rows of the raw data
+        rows = leaves[np.asarray(cluster)]
+        if expand:
+            rows = dataset.expandRows(rows)
+        foundMetabs = pd.DataFrame(rawData[rows,:],columns=columns)
         #add identities to the first column of the data that will be output
-        foundMetabs.insert(0, "Identities", idents, True)
-
-        chkBuffer = glob.glob("*.xlsx")
-        count = 1
-        if 'EnsembleCluster01.xlsx' in chkBuffer:
-            checkVal = False
-            while checkVal == False:
-                count += 1
-                #search the "buffer" for ensemble cluster
-                if count < 10:
-                    #determine if the file has already been made
-                    curFileCheck = ensemPre + '0' + str(count) + ensemSuf
-                    if curFileCheck not in chkBuffer:
-                        checkVal = True
-                        ensemFile = curFileCheck
-                else:
-                    curFileCheck = ensemPre + str(count) + ensemSuf
-                    if curFileCheck not in chkBuffer:
-                        checkVal = True
-                        ensemFile = curFileCheck
-            foundMetabs.to_excel(ensemFile, index=False)
-        else:
-            ensemFile = ensemPre + '0'+ str(count) + ensemSuf 
-            foundMetabs.to_excel(ensemFile, index=False)
-        
+        foundMetabs.insert(0,"Identities",idents[rows],True)
+        clusterFrames.append(foundMetabs)
+
+    writer = getOutputWriter()
+    if mode == 'legacy':
+        files = run.nextNames('EnsembleCluster','.xlsx',count=len(clusterFrames),subDir=outDir)
+        for foundMetabs, ensemFile in zip(clusterFrames,files):
+            writer.saveTable(foundMetabs,ensemFile,index=False)
+
+    elif mode == 'workbook':
+        ensemFile = run.nextNames('EnsembleClusters','.xlsx',subDir=outDir)[0]
+        sheets = {}
+        for i, foundMetabs in enumerate(clusterFrames):
+            sheets['EnsembleCluster' + str(i+1).zfill(2)] = foundMetabs
+        writer.saveWorkbook(sheets,ensemFile,index=False)
+        files = [ensemFile]
+
+    elif mode in ('csv','parquet'):
+        #long format with the cluster number in the first column
+        allClusters = pd.concat(clusterFrames,ignore_index=True)
+        clusterIds = np.repeat(np.arange(1,len(clusterFrames)+1),[len(f) for f in clusterFrames])
+        allClusters.insert(0,"Cluster",clusterIds,True)
+        ensemFile = run.nextNames('EnsembleClusters','.' + mode,subDir=outDir)[0]
+        writer.saveTable(allClusters,ensemFile,index=False)
+        files = [ensemFile]
+
+    else:
+        logging.error(': Unknown cluster export mode ' + str(mode))
+        raise ValueError('Unknown cluster export mode: ' + str(mode))
 
-    #change directory back to the original directory
-    os.chdir('..')
     logging.info(':Success!')
+    return files
+
+def readClusterFiles(files):
+    '''
+    Read in the clusters saved by exportClusters or select.
+
+    Input:
+    files - list of cluster files (excel workbooks, or csv/parquet files with a Cluster column)
+
+    Output:
+    list of DataFrames, one for each cluster.
+    '''
+    clusterFrames = []
+    for file in files:
+        ext = os.path.splitext(file)[1].lower()
+        if ext in ('.csv','.parquet'):
+            allClusters = pd.read_csv(file) if ext == '.csv' else pd.read_parquet(file)
+            if "Cluster" in allClusters.columns:
+                for clusterId, foundMetabs in allClusters.groupby("Cluster",sort=True):
+                    clusterFrames.append(foundMetabs.reset_index(drop=True))
+            else:
+                clusterFrames.append(allClusters)
+        else:
+            #every sheet of a workbook is a cluster
+            sheets = pd.read_excel(file,sheet_name=None)
+            clusterFrames.extend(sheets.values())
+    return clusterFrames
+
+class PeakIndex:
+    '''
+    Reference feature table sorted by retention time, used to find the reference rows of cluster features (see peaksToPathways).
+    A feature matches the reference rows with a retention time within tol, when more than one row matches the m/z value must 
+    also be within tol.
+
+    Input:
+    mz - m/z values of the reference features
+    rt - retention times of the reference features
+
+    Optional:
+    tol - matching tolerance
+    '''
+
+    def __init__(self,mz,rt,tol=0.0001):
+        self.mz = np.asarray(mz,dtype=float)
+        self.rt = np.asarray(rt,dtype=float)
+        self.tol = tol
+        self.order = np.argsort(self.rt,kind='stable')
+        self.rtSorted = self.rt[self.order]
+
+    def match(self,mz,rt):
+        '''
+        Input:
+        mz - m/z values of the features to match
+        rt - retention times of the features to match
+
+        Output:
+        rows - reference rows matched by the features
+        matched - boolean array, False for features without a retention time match
+        '''
+        mz = np.asarray(mz,dtype=float)
+        rt = np.asarray(rt,dtype=float)
+        tol = self.tol
+
+        #window of candidate reference rows for every feature
+        lo = np.searchsorted(self.rtSorted,rt-tol,side='left')
+        hi = np.searchsorted(self.rtSorted,rt+tol,side='right')
+        width = hi - lo
+        query = np.repeat(np.arange(rt.shape[0]),width)
+        pos = np.arange(width.sum()) - np.repeat(np.cumsum(width)-width,width) + np.repeat(lo,width)
+        rows = self.order[pos]
+
+        #exact retention time test on the candidates
+        keep = np.abs(self.rt[rows]-rt[query]) < tol
+        query, rows = query[keep], rows[keep]
+        rtMatches = np.bincount(query,minlength=rt.shape[0])
+
+        #features with more than one retention time match also need a matching m/z
+        keep = (rtMatches[query] == 1) | (np.abs(self.mz[rows]-mz[query]) < tol)
+        return rows[keep], rtMatches > 0
+
+def peaksInit(mz,rt):
+    '''
+    Pool initializer for peaksFile. The csv lines of every reference feature are formatted once, with a p-value of 0.04 (matched)
+    and of 1 (not matched), so each file only needs to put the lines in order.
+
+    Input:
+    mz - m/z values of the reference features
+    rt - retention times of the reference features
+    '''
+    global peaksHeader, peaksMatched, peaksOther
+    dataOut = np.ones((mz.shape[0],3))
+    dataOut[:,0] = mz
+    dataOut[:,2] = rt
+    dataOut = pd.DataFrame(dataOut,columns=["m.z","p.value",'r.t'])
+    lines = dataOut.to_csv(index=False).splitlines(keepends=True)
+    peaksHeader = lines[0]
+    peaksOther = np.array(lines[1:],dtype=object)
+    dataOut["p.value"] = 0.04
+    peaksMatched = np.array(dataOut.to_csv(index=False).splitlines(keepends=True)[1:],dtype=object)
+
+def peaksFile(rows,file):
+    '''
+    Write a peaks to pathways (mummichog input) file, the matched reference rows (p-values of 0.04) come first followed by the 
+    rest of the reference features (p-values of 1). 
+
+    Input:
+    rows - reference rows matched by the cluster
+    file - output file name
+    '''
+    matched = np.zeros(peaksOther.shape[0],dtype=bool)
+    matched[rows] = True
+    with open(file,'w',newline='') as f:
+        f.write(peaksHeader)
+        f.write(''.join(peaksMatched[matched]))
+        f.write(''.join(peaksOther[~matched]))
+    return file
+
+def peaksToPathwaysFiles(peakIndex,clusterRows,files,numThreads=1):
+    '''
+    Write the peaks to pathways files of many clusters, spread over a pool of numThreads processes.
+
+    Input:
+    peakIndex - PeakIndex of the reference features
+    clusterRows - list of the matched reference rows of each cluster
+    files - list of output file names
+
+    Optional:
+    numThreads - number of processes to use (config.numThreads)
+
+    Output:
+    list of the files written.
+    '''
+    args = list(zip(clusterRows,files))
+    numThreads = min(int(numThreads),len(args))
+    if numThreads <= 1:
+        peaksInit(peakIndex.mz,peakIndex.rt)
+        return [peaksFile(rows,file) for rows, file in args]
+
+    with Pool(numThreads,initializer=peaksInit,initargs=(peakIndex.mz,peakIndex.rt)) as p:
+        return p.starmap(peaksFile,args)
 
-def readInColumns(metab_data):
+def readInColumns(metab_data,mmapFile=None,dtype=np.float64):
     '''
     Robust excel reading in tool. 
 
     Input:
     metab_data -raw excel file
 
+    Optional:
+    mmapFile - .npy file to hold the columns as a memory-mapped array (np.memmap) instead of in memory
+    dtype - data type of the output (e.g., float32 to halve the size of large inputs)
+
     Output:
     Columns of metabolites, this goes with the convention that the submitted files contain the metabolite intensities in the 2->(N-1) columns.
     '''
     #creating a numpy array that is the size of the data that is being read in.
-    data = np.zeros((metab_data.shape[0],metab_data.shape[1]-2))
+    shape = (metab_data.shape[0],metab_data.shape[1]-2)
+    if mmapFile is None:
+        data = np.zeros(shape,dtype=dtype)
+    else:
+        data = np.lib.format.open_memmap(mmapFile,mode='w+',dtype=dtype,shape=shape)
 
     columnsData = list(metab_data.columns)
     
@@ -1164,7 +2723,7 @@ def readInColumns(metab_data):
     
     return data
     
-def select(index,dend,link,linkDir,linkClust,data_orig):
+def select(index,dend,link,linkDir,linkClust,data_orig,run=None,dataset=None):
     '''
     Function responsible for the coloring clustergram based upon users selection. This function is also responsible for saving the selected cluster
     
@@ -1177,6 +2736,10 @@ def select(index,dend,link,linkDir,linkClust,data_orig):
     linkage clustering
     original data
 
+    Optional:
+    run - OutputRun the cluster files belong to
+    dataset - Dataset of data_orig, duplicates collapsed by the dataset are added back to the saved cluster
+
     Output:
     excel workbook with selected values
 
@@ -1270,12 +2833,25 @@ def select(index,dend,link,linkDir,linkClust,data_orig):
         messagebox.showerror(title="Error",message='Make sure to select vertical lines only, selecting horizontal lines will continue to result in this error! YOU MAY NEED TO RESTART THE CLUSTER SELECTION!')
     
     
-    with open('ClusterReference.txt') as f:
+    run = getOutputRun(run)
+    clustRef = run.path('ClusterReference.txt')
+    with open(clustRef) as f:
         lines = f.read()
 
 
 
     
+    #look for matches in the list
+    dendrogramLeaveLoc = []
+    dendLeaves = dend['leaves']
+    for i in range(len(clustMetabs)):
+        dendrogramLeaveLoc.append(dendLeaves.index(clustMetabs[i]))
+
+    if dataset is not None and len(dataset.duplicates) > 0:
+        #add the duplicate metabolites collapsed before clustering back to the selection
+        clustMetabs = dataset.expandRows(clustMetabs)
+        data_orig = dataset.fullRaw.to_numpy()
+
     #make the current selection into a .csv file to be submitted to the peaks to Pathways function.
     selectedMetabs = np.zeros([len(clustMetabs),data_orig.shape[1]])
     p2pMetabs = np.ones([data_orig.shape[0],3])
@@ -1285,24 +2861,18 @@ def select(index,dend,link,linkDir,linkClust,data_orig):
 
     for j in clustMetabs:
         p2pMetabs[j,1] = 0.04
-    
-    #look for matches in the list
-    dendrogramLeaveLoc = []
-    dendLeaves = dend['leaves']
+
     for i in range(len(clustMetabs)):
         #for each clustMetabs in the list put the value into a numpy array
         selectedMetabs[i,:] = data_orig[clustMetabs[i],:]
-        dendrogramLeaveLoc.append(dendLeaves.index(clustMetabs[i]))
 
 
     lines = lines.split("\n")
     lenTxt = len(lines)
     newCluster = "\n" 
-    open('ClusterReference.txt','a').write(newCluster)
-    open('ClusterReference.txt','a').write(str(len(dendrogramLeaveLoc)))
+    open(clustRef,'a').write(newCluster)
+    open(clustRef,'a').write(str(len(dendrogramLeaveLoc)))
 
-    clustPre = 'Cluster'
-    clustSuf = '.xlsx'
     #create column headers for the data frame
     columnHeaders = selectedMetabs.shape[1]
     columns = []
@@ -1317,32 +2887,12 @@ def select(index,dend,link,linkDir,linkClust,data_orig):
     p2pFile = pd.DataFrame(p2pMetabs,columns=["m.z","p.value","r.t"])
     p2pFile = p2pFile.sort_values(by=['p.value'], ascending=True)
 
-    chkBuffer = glob.glob("*.xlsx")
-    count = 1
-    if 'Cluster01.xlsx' in chkBuffer:
-        checkVal = False
-        while checkVal == False:
-            count += 1
-            #search the "buffer" for ensemble cluster
-            if count < 10:
-                #determine if the file has already been made
-                curFileCheck = clustPre + '0' + str(count) + clustSuf
-                if curFileCheck not in chkBuffer:
-                    checkVal = True
-                    clustFile = curFileCheck
-            else:
-                curFileCheck = clustPre + str(count) + clustSuf
-                if curFileCheck not in chkBuffer:
-                    checkVal = True
-                    clustFile = curFileCheck
-        foundMetabs.to_excel(clustFile, index=False)
-        p2pF = "P2P_"+ clustFile.rstrip('.xlsx') + '.csv'
-        p2pFile.to_csv(p2pF,index=False)
-    else:
-        clustFile = clustPre + '0'+ str(count) + clustSuf 
-        foundMetabs.to_excel(clustFile, index=False)
-        p2pF = "P2P_"+ clustFile.rstrip('.xlsx') +'.csv'
-        p2pFile.to_csv(p2pF,index=False)
+    #allocate the next cluster file and the matching peaks to pathways file
+    writer = getOutputWriter()
+    clustFile = run.nextNames('Cluster','.xlsx')[0]
+    p2pF = run.path("P2P_"+ os.path.splitext(os.path.basename(clustFile))[0] + '.csv')
+    writer.saveTable(foundMetabs,clustFile,index=False)
+    writer.saveTable(p2pFile,p2pF,index=False)
     logging.info(':Success!')
 
 
@@ -1402,6 +2952,210 @@ def linkDir(linkageOne,maxIndex):
     return linkageDir
 
 
+class Dataset:
+    '''
+    Input file read in a single time. The first row of the file contains the group of each sample, the first column contains the
+    identities (m/z) of the metabolites and the last column contains the retention times.
+
+    Input:
+    metab_data - DataFrame of the input file (fileCheck output)
+
+    Optional:
+    mmapDir - directory for memory-mapped copies of the numeric matrix (see readInColumns), each file is removed once the array mapped
+    from it is no longer used (see removeWhenUnused)
+    dtype - data type of the numeric matrix
+
+    Attributes:
+    metab_data - DataFrame of the input file
+    raw - input file without the group row (same as readAndPreProcess with func='Raw')
+    groups - Series with the group of each sample
+    identities - Series of the metabolite identities
+    rt - Series of the metabolite retention times
+    values - numeric matrix of the metabolite intensities (created on first use)
+    duplicates - groups of rows of fullRaw with identical intensities, filled in by collapseDuplicates
+    fullRaw - raw before the duplicates were collapsed
+    '''
+
+    def __init__(self,metab_data,mmapDir=None,dtype=np.float64):
+        self.metab_data = metab_data
+        self.raw = metab_data.iloc[1:].reset_index(drop=True)
+        self.groups = metab_data.iloc[0,1:-1].reset_index(drop=True)
+        self.identities = self.raw.iloc[:,0]
+        self.rt = self.raw.iloc[:,-1]
+        self.dtype = np.dtype(dtype)
+        self._values = None
+        self.duplicates = []
+        self.fullRaw = self.raw
+        self._inverse = None
+
+        self.mmapDir = mmapDir
+        if mmapDir is not None:
+            os.makedirs(mmapDir,exist_ok=True)
+
+    def mapFile(self,name):
+        '''
+        Path of a new memory-mapped file of this dataset, None when the dataset is kept in memory.
+        '''
+        if self.mmapDir is None:
+            return None
+        fd, file = tempfile.mkstemp(suffix='.npy',prefix=mapFilePrefix + str(os.getpid()) + '-' + name + '-',dir=self.mmapDir)
+        os.close(fd)
+        return file
+
+    @property
+    def values(self):
+        if self._values is None:
+            mmapFile = self.mapFile('values')
+            self._values = readInColumns(self.raw,mmapFile=mmapFile,dtype=self.dtype)
+            if mmapFile is not None:
+                removeWhenUnused(self._values,mmapFile)
+        return self._values
+
+    def collapseDuplicates(self):
+        '''
+        Keep a single row of every group of metabolites with identical intensities, so the duplicates are clustered once. The
+        rows of the clusters are mapped back to every duplicate with expandRows.
+
+        Output:
+        number of rows removed
+        '''
+        groups, keep, inverse = duplicateGroups(self.values)
+        if len(groups) == 0:
+            return 0
+        self.duplicates = groups
+        self._inverse = inverse
+        self.raw = self.fullRaw.iloc[keep].reset_index(drop=True)
+        self.metab_data = pd.concat([self.metab_data.iloc[:1],self.metab_data.iloc[1:].iloc[keep]],ignore_index=True)
+        self.identities = self.raw.iloc[:,0]
+        self.rt = self.raw.iloc[:,-1]
+        self._values = None
+        return self.fullRaw.shape[0] - keep.shape[0]
+
+    def expandRows(self,rows):
+        '''
+        Input:
+        rows - rows of raw (after collapseDuplicates)
+
+        Output:
+        rows of fullRaw, every duplicate of a row follows the row.
+        '''
+        rows = np.asarray(rows,dtype=int)
+        if self._inverse is None:
+            return rows
+        order = np.argsort(self._inverse,kind='stable')
+        counts = np.bincount(self._inverse)
+        starts = np.cumsum(counts) - counts
+        width = counts[rows]
+        pos = np.arange(width.sum()) - np.repeat(np.cumsum(width)-width,width) + np.repeat(starts[rows],width)
+        return order[pos]
+
+    def close(self):
+        '''
+        Release the metabolite intensities of the dataset, a memory-mapped file is removed once no other array uses it.
+        '''
+        self._values = None
+
+    def preProcess(self,transform='None',scale='None',first='1'):
+        '''
+        Transform and scale a copy of the metabolite intensities.
+
+        Input:
+        transform - selected transformation
+        scale - selected data scaling
+        first - column used for normalization
+
+        Output:
+        Pre-processed data
+        '''
+        mmapFile = self.mapFile('preprocessed')
+        if mmapFile is None:
+            data = self.values.copy()
+        else:
+            #copy into a new memory-mapped file and pre-process it in place
+            data = np.lib.format.open_memmap(mmapFile,mode='w+',dtype=self.dtype,shape=self.values.shape)
+            removeWhenUnused(data,mmapFile)
+            data[:] = self.values
+        return transformations(data,transform=transform,scale=scale,first=first)
+
+#memory-mapped files are named prefix + process id + '-' so the files left by processes that did not exit cleanly can be found
+mapFilePrefix = 'ECCO-'
+
+def removeFile(file):
+    '''
+    Remove a file, logging a warning if it cannot be removed.
+    '''
+    try:
+        os.remove(file)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        logging.warning(': Unable to remove the memory-mapped file ' + str(file))
+
+def removeWhenUnused(data,file):
+    '''
+    Remove a memory-mapped file once the array mapped from it, and every view of the array, is no longer used. The removal is tied to the
+    mmap of the array rather than the array, so the file is only removed after it has been unmapped (Windows cannot remove mapped files).
+
+    Input:
+    data - np.memmap of the file
+    file - path of the file
+    '''
+    mapping = data.base if isinstance(data.base, mmap.mmap) else data
+    weakref.finalize(mapping,removeFile,file)
+
+def removeStaleMapFiles(mmapDir):
+    '''
+    Remove the memory-mapped files left in mmapDir by earlier runs that did not exit cleanly. Files of running processes are kept (on 
+    Windows the files still mapped by another process cannot be removed).
+
+    Input:
+    mmapDir - directory of the memory-mapped files
+    '''
+    pattern = re.compile(re.escape(mapFilePrefix) + r'(\d+)-.*\.npy$')
+    with os.scandir(mmapDir) as entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match is None or int(match.group(1)) == os.getpid():
+                continue
+            if os.name == 'posix':
+                try:
+                    os.kill(int(match.group(1)),0)
+                    continue
+                except ProcessLookupError:
+                    pass
+                except OSError:
+                    continue
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+staleMapDirs = set()
+
+def loadDataset(file=''):
+    '''
+    Read in the input file a single time for all of the steps of an analysis.
+
+    Input:
+    file - full path to the input file, the user is asked to select a file if not given.
+
+    Output:
+    Dataset (duplicate metabolites collapsed if config.collapseDuplicates), or None if the file could not be read.
+    '''
+    metab_data = fileCheck(file=file)
+    if metab_data is None:
+        logging.error(': Error loading in the Excel sheet.')
+        return
+    if config.memmapDir is not None and config.memmapDir not in staleMapDirs and os.path.isdir(config.memmapDir):
+        #clear out the files left by earlier runs once per session
+        staleMapDirs.add(config.memmapDir)
+        removeStaleMapFiles(config.memmapDir)
+    dataset = Dataset(metab_data,mmapDir=config.memmapDir,dtype=config.memmapDtype)
+    if config.collapseDuplicates:
+        numRemoved = dataset.collapseDuplicates()
+        logging.info(': ' + str(numRemoved) + ' duplicate metabolites collapsed before clustering.')
+    return dataset
+
 def readAndPreProcess(file='',transform = 'None', scale ='None',func='else',first ='1'):
     '''
     readAndPreProcess
@@ -1409,6 +3163,7 @@ def readAndPreProcess(file='',transform = 'None', scale ='None',func='else',firs
     This function is designed to remove the reading in and pre-processing of the data from the beginning of each function which needs to read-in and pre-process the data, saying large amounts of lines in this program.
 
     Input:
+    file - full path to the file or a Dataset that has already been read in
     transform
     scale
     func
@@ -1418,62 +3173,51 @@ def readAndPreProcess(file='',transform = 'None', scale ='None',func='else',firs
 
     '''
 
-    #check that the file the user selects is appropriate
-    ###Should only be used when reading in excel files.
-    metab_data = fileCheck(file=file)
+    if isinstance(file, Dataset):
+        #use the data that has already been read in
+        dataset = file
+    else:
+        #check that the file the user selects is appropriate
+        ###Should only be used when reading in excel files.
+        dataset = loadDataset(file=file)
 
-    if metab_data is None:
+    if dataset is None:
         #log error message and return for soft exit.
         logging.error(': Error loading in the Excel sheet.')
         return
 
    
     if func =='CC':
-        metab_dataCol = list(metab_data.columns)
-        col_groups = metab_data.iloc[0]
-        col_groups = col_groups.to_list()
-        col_groups.pop(0)
-        col_groups.pop(len(col_groups)-1)
-        col_groups = pd.Series(col_groups,copy=False)
-        metab_data = metab_data.drop(0,axis=0)
-        #read in data
-        data = readInColumns(metab_data)
-
         #put the data through the appropriate transformations. 
-        data = transformations(data,transform=transform,scale=scale, first=first)
-
-        return data, col_groups
+        data = dataset.preProcess(transform=transform,scale=scale,first=first)
+        return data, dataset.groups
 
     elif func == 'ANHM':
-        #remove the first row of data.
-        metab_data = metab_data.iloc[1:,:]
-
-        data = readInColumns(metab_data)
-
-        data = transformations(data,transform=transform,scale=scale,first=first)
+        data = dataset.preProcess(transform=transform,scale=scale,first=first)
         return data
 
     elif func =='Raw':
-        metab_data = metab_data.drop(0,axis=0)
-        metab_data.reset_index(inplace=True,drop=True)
-        return metab_data
+        return dataset.raw
 
     else:
         #read in data
-        data = readInColumns(metab_data)
+        data = readInColumns(dataset.metab_data)
         #transform the data
         data = transformations(data,transform=transform,scale=scale,first=first)
         return data
 
 
     
-def createHeatmapFig(clMap):
+def createHeatmapFig(clMap,run=None):
     '''
     This function is responsible for creating the heatmap that is submitted by the user. 
 
     Input: 
     clMap: choosen color map scheme
 
+    Optional:
+    run: OutputRun containing the ClusterReference.txt of the cluster selection
+
     Output:
     editable pdf that with each of the selected clusters.
     '''
@@ -1491,7 +3235,9 @@ def createHeatmapFig(clMap):
     g = sns.heatmap(data,yticklabels=False,cmap=clMap)
 
     #save the heatmap of the data
-    plt.savefig('Heatmap.png',dpi=600)
+    run = getOutputRun(run)
+    heatmapFile = run.path('Heatmap.png')
+    plt.savefig(heatmapFile,dpi=600)
     del(g)
 
     #create the pdf for publication
@@ -1501,11 +3247,11 @@ def createHeatmapFig(clMap):
     pdf.set_font('Arial','B',54)
 
     #add image to pdf
-    pdf.image('Heatmap.png',0,0)
+    pdf.image(heatmapFile,0,0)
 
 
     #open the ClusterReference.txt file.
-    with open('ClusterReference.txt') as f:
+    with open(run.path('ClusterReference.txt')) as f:
         lines = f.read()
     lineNew = lines.split("\n")
     
@@ -1580,12 +3326,12 @@ def createHeatmapFig(clMap):
             pdf.cell(300,h=math.floor(boxHeights[i]/2),txt=rMetab, ln=2,align='C')
 
     
-    pdf.output('SelectedClusters.pdf','F')
+    pdf.output(run.path('SelectedClusters.pdf'),'F')
     messagebox.showinfo(title='Success', message='Success, the pdf has been created!')
     return
 
 
-def valPlotting(valIndex, mstOut, valMet = 'KMeansBased'):
+def valPlotting(valIndex, mstOut, valMet = 'KMeansBased',run=None):
 
     '''
     This function is responsible for plotting the validation outcome generated.
@@ -1595,6 +3341,9 @@ def valPlotting(valIndex, mstOut, valMet = 'KMeansBased'):
     mstOut: containing the generated MST
     valMet: the validation metric run
 
+    Optional:
+    run: OutputRun the validation files belong to
+
     Output:
     Plot of the validation output
     csv of the validation output
@@ -1648,12 +3397,14 @@ def valPlotting(valIndex, mstOut, valMet = 'KMeansBased'):
     valIndex.insert(0,"Clusters",rowLabels)
     
     #save to a csv file
-    mstOutFileName = 'MST_branches_' + valMet +'.csv'
-    mstOut.to_csv(mstOutFileName, index=False)
+    writer = getOutputWriter()
+    run = getOutputRun(run)
+    mstOutFileName = run.path('MST_branches_' + valMet +'.csv')
+    writer.saveTable(mstOut,mstOutFileName, index=False)
 
     #save validation measure to csv file
-    valIndexFileName = 'valIndex_' + valMet + '.csv'
-    valIndex.to_csv(valIndexFileName, index=False)
+    valIndexFileName = run.path('valIndex_' + valMet + '.csv')
+    writer.saveTable(valIndex,valIndexFileName, index=False)
 
     #logging the completion of the Minimum spanning tree
     logging.info(': Sucessfully completed clustering validation!')
@@ -1680,71 +3431,180 @@ def valPlotting(valIndex, mstOut, valMet = 'KMeansBased'):
     else:
         title = valMet + " Validation"
     plt.title(title,pad = 15,fontsize=36,fontname="Arial")
-    pltFileName = valMet+"Validation.png"
-    plt.savefig(pltFileName,bbox_inches='tight',dpi=600,transparent=True)
+    pltFileName = run.path(valMet+"Validation.png")
+    writer.saveFigure(plt.gcf(),pltFileName,bbox_inches='tight',dpi=600,transparent=True)
     plt.show()
 
 
 
-def dataCheck(data):
+def groupReduce(values,labels,stats=('median',)):
+    '''
+    Reduce the samples (rows) of each group to one row per group for every feature (column). The samples are sorted by group once
+    and every statistic is computed from the same sorted blocks.
+
+    Input:
+    values - samples x features array
+    labels - group of each sample
+
+    Optional:
+    stats - statistics to compute, any of 'median', 'mean', 'mad' (median absolute deviation) and 'nonzero' (fraction of non-zero samples)
+
+    Output:
+    groups - sorted group labels
+    reduced - dictionary of statistic name to a groups x features array
+    '''
+    values = np.asarray(values,dtype=float)
+    groups, codes = np.unique(np.asarray(labels),return_inverse=True)
+    order = np.argsort(codes,kind='stable')
+    starts = np.concatenate(([0],np.cumsum(np.bincount(codes,minlength=len(groups)))))
+    sortedValues = values[order,:]
+
+    reduced = {}
+    for statName in stats:
+        if statName not in ('median','mean','mad','nonzero'):
+            logging.warning(': Unknown group statistic ' + str(statName))
+            continue
+        reduced[statName] = np.zeros((len(groups),values.shape[1]))
+
+    for i in range(len(groups)):
+        block = sortedValues[starts[i]:starts[i+1],:]
+        if 'median' in reduced or 'mad' in reduced:
+            median = np.median(block,axis=0)
+            if 'median' in reduced:
+                reduced['median'][i,:] = median
+            if 'mad' in reduced:
+                reduced['mad'][i,:] = np.median(np.abs(block-median),axis=0)
+        if 'mean' in reduced:
+            reduced['mean'][i,:] = block.mean(axis=0)
+        if 'nonzero' in reduced:
+            reduced['nonzero'][i,:] = np.count_nonzero(block,axis=0)/block.shape[0]
+    return groups, reduced
+
+#decimal points following the first decimal point of a value (values are joined by new lines)
+extraDecimals = re.compile(r'(?<=\.)([^.\n]*)\.')
+
+def repairDecimals(column):
+    '''
+    Remove the extra decimal points (e.g., 1.234.5 -> 1.2345) from the malformed values of a column of MetaboAnalyst outputs.
+
+    Input:
+    column - pandas Series of floats and strings
+
+    Output:
+    numpy array of floats, raises ValueError if a value can not be converted.
+    '''
+    column = np.asarray(column,dtype=object)
+    isString = np.array([type(value) is str for value in column],dtype=bool)
+    values = np.zeros(column.shape[0])
+    try:
+        values[~isString] = column[~isString].astype(float)
+        if isString.any():
+            #repair all of the strings with a single pass of the pattern, then convert them in bulk
+            text = extraDecimals.sub(r'\1','\n'.join(column[isString]))
+            values[isString] = np.array(text.split('\n')).astype(float)
+    except ValueError:
+        raise ValueError('Unable to convert values to floats, make sure all data values only contain decimals or numeric values')
+    return values
+
+def integrityFile(file,outDir,outExt=None):
+    '''
+    Correct the first column ('Unnamed: 0') of a MetaboAnalyst volcano plot output, can be run in a worker pool for many files.
+
+    Input:
+    file - volcano plot output (excel, csv or tsv)
+    outDir - directory the corrected file is saved to
+
+    Optional:
+    outExt - extension of the corrected file ('.xlsx' or '.csv'), defaults to csv for text inputs and excel otherwise
+
+    Output:
+    name of the corrected file (the original file name with _corrected appended).
+    '''
+    name, ext = os.path.splitext(os.path.basename(file))
+    ext = ext.lower()
+    if ext == '.csv':
+        volcano = pd.read_csv(file)
+    elif ext in ('.tsv','.txt'):
+        volcano = pd.read_csv(file,sep='\t')
+    else:
+        volcano = pd.read_excel(file)
+
+    volcano['Unnamed: 0'] = repairDecimals(volcano['Unnamed: 0'])
+
+    if outExt is None:
+        outExt = '.csv' if ext in ('.csv','.tsv','.txt') else '.xlsx'
+    outFile = os.path.join(outDir,name + '_corrected' + outExt)
+    if outExt == '.csv':
+        volcano.to_csv(outFile,index=False)
+    else:
+        volcano.to_excel(outFile,index=False)
+    return outFile
+
+def duplicateGroups(data):
+    '''
+    Find the groups of identical rows (duplicate features) by sorting the rows, rows containing NaN are never matched.
+
+    Input:
+    data - features x samples array
+
+    Output:
+    groups - list of arrays of the rows in each group of identical rows, only groups of more than one row (ordered by their first row)
+    keep - first row of every distinct row, in ascending order
+    inverse - position in keep of the distinct row matching each row
+    '''
+    data = np.ascontiguousarray(data,dtype=float) + 0.0
+    numRows = data.shape[0]
+    firstRow = np.arange(numRows)
+
+    #compare the bytes of the rows without NaN, adding zero makes -0.0 and 0.0 identical
+    valid = np.flatnonzero(~np.isnan(data).any(axis=1))
+    if valid.shape[0] > 0 and data.shape[1] > 0:
+        rows = data[valid].view(np.dtype((np.void,data.dtype.itemsize*data.shape[1]))).ravel()
+        unique, first, labels = np.unique(rows,return_index=True,return_inverse=True)
+        firstRow[valid] = valid[first[labels.ravel()]]
+
+    keep = np.flatnonzero(firstRow == np.arange(numRows))
+    inverse = np.searchsorted(keep,firstRow)
+
+    #split the rows into their groups, members in ascending order
+    order = np.argsort(firstRow,kind='stable')
+    counts = np.bincount(inverse,minlength=keep.shape[0])
+    groups = np.split(order,np.cumsum(counts)[:-1])
+    groups = [group for group in groups if group.shape[0] > 1]
+    return groups, keep, inverse
+
+def dataCheck(data,run=None):
     '''
     This function is responsible for checking for matching values within the input data, and reducing matching values down to a single value
 
     Input:
     original raw data
 
+    Optional:
+    run - OutputRun the removed indicies file belongs to
+
     Output:
-    Corrected data.
+    Corrected data and a dictionary of the groups of matching rows (first row of each group is kept).
     '''    
     #read in the data from fileCheck and look for matching values
     data = readInColumns(data)
+    groups, keep, inverse = duplicateGroups(data)
 
     dataMatches = {}
-    toDelete = []
-
-    for i in range(data.shape[0]):
-        curMatch = []
-        #skip the iteration if the value is already flagged to be deleted due to matching.
-        if i in toDelete:
-            continue
+    for i in range(len(groups)):
+        dataMatches[i] = list(groups[i])
+    toDelete = [j for group in groups for j in group[1:]]
 
-        for j in range(i+1,data.shape[0]):
-            #skip the iteration if the value is already flagged to be deleted due to matching. 
-            if j in toDelete:
-                continue
-
-            #check the current array v. the other arrays
-            curCheck = data[i,:] == data[j,:]
-
-            if np.all(curCheck):
-                if len(curMatch) == 0:
-                    #inputting the matched indicies to a list to be input to a dictionary.
-                    curMatch.append(i)
-                    curMatch.append(j)
-                    toDelete.append(j)
-                else:
-                    curMatch.append(j)
-                    toDelete.append(j)
-        
-        #if the length of list curMatch is non-zero add to the dictionary
-        if len(curMatch)>0:
-            #get dictionary of matching intensities and input to the dictionary using current length as key
-            dictLen = len(dataMatches)
-
-            #if this gives trouble automatically update the dictionary with each found match for each i
-            dataMatches[dictLen] = curMatch
-    
     #delete the extraneous matching rows.
-    data = np.delete(data,toDelete,axis=0)
+    data = data[keep,:]
     
     dataMessage = str(len(toDelete))
     removedIndicies = pd.DataFrame(toDelete)
-    removedIndicies.to_excel('RemovedIndicies.xlsx',index=False)
+    removedIndicies.to_excel(getOutputRun(run).path('RemovedIndicies.xlsx'),index=False)
     messagebox.showwarning(title="Matching Values removed",message=dataMessage + " matching values found and removed")
 
-    return data
+    return data, dataMatches
 
-        
 def transformations(data, transform='None', scale='None',first='1'):
     '''
     This function is responsible for taking inputs from the broad range of functions needed data transformed or scaled and updating the data
@@ -1752,7 +3612,7 @@ def transformations(data, transform='None', scale='None',first='1'):
     Input:
     data: raw data
     transform: selected transformation
-    scale: selected data scaling
+    scale: selected data scaling ('NormStand' normalizes to column first, it is applied after any transform, including 'None')
 
     Output:
     Pre-processed data
@@ -1763,170 +3623,19 @@ def transformations(data, transform='None', scale='None',first='1'):
     ###------------------------------------------------------------- Transforming and Scaling Data -----------------------------------------------------------------
     ###-------------------------------------------------------------------------------------------------------------------------------------------------------------
 
-    ### UPDATED THE RANGE FOR THE FOR LOOP TO DATA INSTEAD OF METAB_DATA
-
-    #Log transform no scaling
-    if transform == 'Log transformation' and scale == 'None':
-        for i in range(data.shape[0]):
-            data[i,:] = logTrans(data[i,:])
-
-    #Log transform, mean centering
-    elif transform == 'Log transformation' and scale == 'Mean centering':
-        #log transform
-        for i in range(data.shape[0]):
-            data[i,:] = logTrans(data[i,:])
-
-        #mean center
-        for i in range(data.shape[0]):
-            data[i,:] = meanCentering(data[i,:])
-    
-    #log transform, auto scaling
-    elif transform == 'Log transformation' and scale == 'Auto Scaling':
-        #log transform
-        for i in range(data.shape[0]):
-            data[i,:] = logTrans(data[i,:])
-
-        #Auto scale
-        for i in range(data.shape[0]):
-            data[i,:] = standardize(data[i,:])
-
-    #log transform, pareto scaling
-    elif transform == 'Log transformation' and scale == 'Pareto Scaling':
-        #log transform
-        for i in range(data.shape[0]):
-            data[i,:] = logTrans(data[i,:])
-
-        #Pareto scale
-        for i in range(data.shape[0]):
-            data[i,:] = paretoScaling(data[i,:])
-
-    #log transform, range scaling
-    elif transform == 'Log transformation' and scale == 'Range Scaling':
-        #log transform
-        for i in range(data.shape[0]):
-            data[i,:] = logTrans(data[i,:])
-
-        #Range scale
-        for i in range(data.shape[0]):
-            data[i,:] = rangeScaling(data[i,:])
-
-    elif transform == 'Log transformation' and scale =='NormStand':
-        #log transform
-        for i in range(data.shape[0]):
-            data[i,:] = logTrans(data[i,:])
-        
-        for i in range(data.shape[0]):
-            data[i,:] = normStandardize(data[i,:],first)
-
-    #Square root transform, no scaling
-    elif transform == 'Square root transformation' and scale == 'None':
-        #square root transform
-        for i in range(data.shape[0]):
-            data[i,:] = sqrtTrans(data[i,:])
-
-    #square root transform, mean centering
-    elif transform == 'Square root transformation' and scale == 'Mean centering':
-        #square root transform
-        for i in range(data.shape[0]):
-            data[i,:] = sqrtTrans(data[i,:])
-
-        #mean center
-        for i in range(data.shape[0]):
-            data[i,:] = meanCentering(data[i,:])
-
-    #square root transform, auto scaling
-    elif transform == 'Square root transformation' and scale == 'Auto Scaling':
-        #square root transform
-        for i in range(data.shape[0]):
-            data[i,:] = sqrtTrans(data[i,:])
-
-        #auto scale
-        for i in range(data.shape[0]):
-            data[i,:] = standardize(data[i,:])
-
-    #square root transform, pareto scaling
-    elif transform == 'Square root transformation' and scale == 'Pareto Scaling':
-        #square root transform
-        for i in range(data.shape[0]):
-            data[i,:] = sqrtTrans(data[i,:])
-
-        #pareto scale
-        for i in range(data.shape[0]):
-            data[i,:] = paretoScaling(data[i,:])
-
-    #square root transform, range scaling
-    elif transform == 'Square root transformation' and scale == 'Range Scaling':
-        #square root transform
-        for i in range(data.shape[0]):
-            data[i,:] = sqrtTrans(data[i,:])
-
-        #range scale
-        for i in range(data.shape[0]):
-            data[i,:] = rangeScaling(data[i,:])
-
-    #cube root transform, no scaling
-    elif transform == 'Cube root transformation' and scale == 'None':
-        #cube root transform
-        for i in range(data.shape[0]):
-            data[i,:] = cubeRtTrans(data[i,:])
-
-    #cube root transform, mean centering
-    elif transform == 'Cube root transformation' and scale == 'Mean centering':
-        #cube root transform
-        for i in range(data.shape[0]):
-            data[i,:] = cubeRtTrans(data[i,:])
-
-        #mean centering
-        for i in range(data.shape[0]):
-            data[i,:] = meanCentering(data[i,:])
-    
-    #cube root transform, auto scale
-    elif transform == 'Cube root transformation' and scale == 'Auto Scaling':
-        #cube root transform
-        for i in range(data.shape[0]):
-            data[i,:] = cubeRtTrans(data[i,:])
-
-        #auto scale
-        for i in range(data.shape[0]):
-            data[i,:] = standardize(data[i,:])
-
-    elif transform == 'Cube root transformation' and scale == 'Pareto Scaling':
-        #cube root transform
-        for i in range(data.shape[0]):
-            data[i,:] = cubeRtTrans(data[i,:])
-
-        #pareto scale
-        for i in range(data.shape[0]):
-            data[i,:] = paretoScaling(data[i,:])
-
-    elif transform == 'Cube root transformation' and scale == 'Range Scaling':
-        #cube root transform
-        for i in range(data.shape[0]):
-            data[i,:] = cubeRtTrans(data[i,:])
-        
-        #range scale
-        for i in range(data.shape[0]):
-            data[i,:] = rangeScaling(data[i,:])
-
-    elif transform == 'None' and scale == 'Mean centering':
-        #mean centering
-        for i in range(data.shape[0]):
-            data[i,:] = meanCentering(data[i,:])
-
-    elif transform == 'None' and scale == 'Auto Scaling':
-        #auto scaling
-        for i in range(data.shape[0]):
-            data[i,:] = standardize(data[i,:])
-
-    elif transform == 'None' and scale == 'Pareto Scaling':
-        #pareto scale
-        for i in range(data.shape[0]):
-            data[i,:] = paretoScaling(data[i,:])
-
-    elif transform == 'None' and scale == 'Range Scaling':
-        #range scale 
-        for i in range(data.shape[0]):
-            data[i,:] = rangeScaling(data[i,:])
+    #transform the whole matrix
+    if transform in transformFunctions:
+        data = transformFunctions[transform](data)
+    elif transform != 'None':
+        logging.warning(': Unknown data transformation ' + str(transform) + ', data not transformed.')
+
+    #scale each row of the matrix
+    if scale == 'NormStand':
+        data = normStandardize(data,first)
+    elif scale in scaleFunctions:
+        data = scaleFunctions[scale](data)
+    elif scale != 'None':
+        logging.warning(': Unknown data scaling ' + str(scale) + ', data not scaled.')
 
     return data
 
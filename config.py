@@ -25,3 +25,45 @@ numPerSamp = 0
 curTrans = 'None'
 curScale = 'None'
 
+#cache of parsed input files (a relative directory is placed in the user's cache directory, e.g. %LOCALAPPDATA%\ECCO or ~/.cache/ECCO, 
+#size limit in MB)
+useInputCache = True
+inputCacheDir = 'InputCache'
+inputCacheSize = 2048
+
+#memory-mapped numeric matrix for large inputs (directory for the mapped files, None keeps the matrix in memory). Each file is removed once
+#its array is no longer used, files left by runs that did not exit cleanly are removed when the next input is read.
+memmapDir = None
+memmapDtype = 'float64'
+
+#format of the ensemble cluster files ('workbook', 'csv', 'parquet' or 'legacy' for a workbook per cluster)
+clusterExport = 'workbook'
+
+#ensemble co-occurrence output (.npz counts, the csv of the full matrix is optional). Compressed files are smaller but have to be read 
+#fully into memory when loaded again, uncompressed files can be memory-mapped.
+coOccCompress = False
+coOccCSV = False
+
+#background writing of figures and output files (number of writer threads, number of outputs that can be waiting)
+backgroundOutput = True
+outputWriters = 2
+outputQueueSize = 8
+
+#directory for the output files of the default run (None uses the current working directory)
+outputDir = None
+
+#group statistics saved by groupMedians in addition to the medians ('mean', 'mad', 'nonzero')
+groupStats = ()
+
+#cluster a single copy of metabolites with identical intensities, the copies are added back to the cluster files
+collapseDuplicates = False
+
+#size limit of the linkage matrices kept for the session in MB (linkages of the same data, linkage function and distance metric are reused)
+linkageCacheSize = 512
+
+#silhouette validation (rows of distances computed at a time, number of features sampled from each cluster for an estimate, None uses 
+#every feature, the confidence of the estimate's error bounds and the seed of the sample, None gives a different sample each run)
+silhouetteBlock = 2048
+silhouetteSample = None
+silhouetteConfidence = 0.95
+silhouetteSeed = None